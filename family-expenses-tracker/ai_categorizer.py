@@ -0,0 +1,276 @@
+"""
+Gemini-backed transaction categorisation.
+
+Transactions are split into chunks that fit a prompt token budget, and the
+chunks are sent concurrently on a small process-wide pool (add-on options
+ai_max_workers and ai_chunk_timeout_s). A failing or slow chunk only loses
+its own transactions; the others are still returned.
+
+Answers are remembered per merchant in the ai_category_cache table, so a
+recurring merchant is only sent to the model once.
+
+The model that last answered and the account's model list are kept per
+process, so requests do not walk MODELS_TO_TRY through failing models or
+call list_models every time.
+"""
+import json
+import math
+import re
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, TimeoutError as FutureTimeout
+from datetime import datetime, timezone
+from typing import Dict, Iterable, List, Optional, Sequence, Tuple
+
+from sqlalchemy.dialects.sqlite import insert as sqlite_insert
+from sqlmodel import Session, select
+
+from database import OPTIONS
+from models import AICategoryCache
+
+# Rough prompt size of the transaction lines in one chunk (~4 characters per token)
+AI_CHUNK_TOKEN_BUDGET = 4000
+# Tried in order until one answers
+MODELS_TO_TRY = ['gemini-2.0-flash', 'gemini-2.0-flash-exp', 'gemini-1.5-flash', 'gemini-1.5-flash-001', 'gemini-pro']
+
+# How long a list_models() answer is reused
+AI_MODEL_LIST_TTL_S = 3600
+
+# Cached answers the model was less sure about are asked again
+AI_CACHE_MIN_CONFIDENCE = 0.6
+
+_executor = ThreadPoolExecutor(max_workers=int(OPTIONS["ai_max_workers"]), thread_name_prefix="ai")
+
+# Store numbers, dates, card digits and reference numbers: "#1234", "0042", "12/03"
+_MERCHANT_NOISE = re.compile(r"[#*]?\d[\d/:.-]*")
+
+def merchant_key(description: str) -> str:
+    """Normalizes a description to its merchant: 'SHELL OIL #57444  ' -> 'shell oil'."""
+    words = _MERCHANT_NOISE.sub(" ", (description or "").lower()).split()
+    return " ".join(w for w in words if any(ch.isalnum() for ch in w))
+
+def lookup_cache(session: Session, keys: Iterable[str]) -> Dict[str, AICategoryCache]:
+    keys = [k for k in set(keys) if k]
+    if not keys:
+        return {}
+    rows = session.exec(
+        select(AICategoryCache)
+        .where(AICategoryCache.merchant_key.in_(keys))
+        # An answer without a confidence is not trusted (NULL never compares true)
+        .where(AICategoryCache.confidence >= AI_CACHE_MIN_CONFIDENCE)
+    ).all()
+    return {row.merchant_key: row for row in rows}
+
+def store_cache(session: Session, answers: Dict[str, dict]):
+    """answers: merchant key -> {"category_id", "rule_pattern", "confidence"}. Upserted in one statement."""
+    rows = [
+        {"merchant_key": key, "updated_at": datetime.now(timezone.utc), **answer, "confidence": _confidence(answer.get("confidence"))}
+        for key, answer in answers.items() if key
+    ]
+    if not rows:
+        return
+    stmt = sqlite_insert(AICategoryCache.__table__)
+    stmt = stmt.on_conflict_do_update(
+        index_elements=["merchant_key"],
+        set_={c: stmt.excluded[c] for c in ("category_id", "rule_pattern", "confidence", "updated_at")},
+    )
+    session.connection().execute(stmt, rows)
+
+def _confidence(value) -> Optional[float]:
+    # The model sometimes answers "0.9" as a string; anything unreadable counts as no confidence
+    try:
+        return float(value) if value is not None else None
+    except (TypeError, ValueError):
+        return None
+
+def estimate_tokens(text: str) -> int:
+    return len(text) // 4 + 1
+
+def chunk_lines(lines: Sequence[str], token_budget: int = AI_CHUNK_TOKEN_BUDGET) -> List[List[str]]:
+    """Packs lines greedily into chunks of at most token_budget estimated tokens (at least one line each)."""
+    chunks, current, used = [], [], 0
+    for line in lines:
+        cost = estimate_tokens(line)
+        if current and used + cost > token_budget:
+            chunks.append(current)
+            current, used = [], 0
+        current.append(line)
+        used += cost
+    if current:
+        chunks.append(current)
+    return chunks
+
+def build_prompt(categories_str: str, transactions_str: str) -> str:
+    return f"""
+You are a helpful personal finance assistant.
+Your task is to categorize the following transactions based on the provided categories.
+You should also suggest a 'rule_pattern' to auto-categorize similar transactions in the future (e.g. for 'Starbucks #123' use 'Starbucks').
+
+Categories:
+{categories_str}
+
+Transactions:
+{transactions_str}
+
+Return a generic JSON list of objects. Each object must have:
+- "id": (int) the transaction id
+- "category_id": (int) the matched category id, or null if absolutely unsure.
+- "rule_pattern": (string) a keyword/substring to match this merchant, or null if generic.
+- "confidence": (number between 0 and 1) how sure you are of the category.
+
+Respond ONLY with the JSON list.
+"""
+
+def parse_response(text_response: str) -> list:
+    # Cleanup markdown
+    if "```json" in text_response:
+        text_response = text_response.split("```json")[1].split("```")[0]
+    elif "```" in text_response:
+        text_response = text_response.split("```")[1].split("```")[0]
+    return json.loads(text_response)
+
+def categorize(transaction_lines: Sequence[str], categories_str: str) -> Tuple[list, List[dict]]:
+    """
+    Sends the "id: description ($amount)" lines to Gemini in concurrent chunks.
+    configure() must already have been called with the API key.
+    Returns (merged results, one report per chunk with its size, latency and error).
+    """
+    timeout = int(OPTIONS["ai_chunk_timeout_s"])
+    started = time.monotonic()
+    if model_status()["working_model"] is None:
+        # Narrow MODELS_TO_TRY to the account's models once, instead of every chunk probing them
+        try:
+            list_generation_models(timeout=timeout)
+        except Exception as e:
+            print(f"Could not list AI models: {e}")
+    chunks = chunk_lines(transaction_lines)
+    futures = [
+        _executor.submit(_categorize_chunk, build_prompt(categories_str, "\n".join(chunk)), timeout)
+        for chunk in chunks
+    ]
+    # Chunks run in waves of ai_max_workers; each wave gets one chunk timeout, so the request never waits longer
+    deadline = started + timeout * math.ceil(len(chunks) / int(OPTIONS["ai_max_workers"]))
+
+    results, reports = [], []
+    for index, (chunk, future) in enumerate(zip(chunks, futures)):
+        try:
+            chunk_results, latency, error = future.result(timeout=max(deadline - time.monotonic(), 0))
+        except FutureTimeout:
+            # The call may still be running; its answer is dropped
+            future.cancel()
+            chunk_results, latency, error = None, time.monotonic() - started, f"Timed out after {timeout} s"
+        reports.append({
+            "chunk": index,
+            "transactions": len(chunk),
+            "latency_ms": round(latency * 1000),
+            "status": "failed" if error else "ok",
+            "error": error,
+        })
+        if chunk_results:
+            results.extend(chunk_results)
+    return results, reports
+
+def _categorize_chunk(prompt: str, timeout: int) -> Tuple[Optional[list], float, Optional[str]]:
+    # Never raises: a failed chunk is reported, the others still count
+    started = time.perf_counter()
+    try:
+        response = _generate(prompt, time.monotonic() + timeout)
+        return parse_response(response.text), time.perf_counter() - started, None
+    except Exception as e:
+        print(f"AI chunk failed: {e}")
+        return None, time.perf_counter() - started, str(e)
+
+def _generate(prompt: str, deadline: float):
+    """Tries the candidate models in turn; each attempt only gets the time left until the chunk's deadline."""
+    import google.generativeai as genai
+
+    last_error = None
+    candidates = candidate_models()
+    for model_name in candidates:
+        remaining = deadline - time.monotonic()
+        if remaining <= 0:
+            last_error = TimeoutError("chunk timeout reached")
+            break
+        try:
+            print(f"Attempting AI categorization with model: {model_name}")
+            model = genai.GenerativeModel(model_name)
+            response = model.generate_content(prompt, request_options={"timeout": remaining})
+            _remember_working_model(model_name)
+            return response
+        except Exception as e:
+            print(f"Failed with {model_name}: {e}")
+            _forget_working_model(model_name)
+            last_error = e
+    raise RuntimeError(f"Tried models {candidates}. Last error: {last_error}")
+
+# --- Process-wide model resolver ---
+
+_model_lock = threading.Lock()
+_api_key: Optional[str] = None
+_working_model: Optional[str] = None
+_working_model_since: Optional[float] = None
+_model_list: Optional[List[str]] = None
+_model_list_at: Optional[float] = None
+
+def configure(api_key: str):
+    """Configures genai; a different key starts over with an empty model cache."""
+    global _api_key, _working_model, _working_model_since, _model_list, _model_list_at
+    import google.generativeai as genai
+
+    genai.configure(api_key=api_key)
+    with _model_lock:
+        if api_key != _api_key:
+            _api_key = api_key
+            _working_model = _working_model_since = None
+            _model_list = _model_list_at = None
+
+def list_generation_models(refresh: bool = False, timeout: Optional[float] = None) -> List[str]:
+    """Names of the models that support generateContent, cached for AI_MODEL_LIST_TTL_S."""
+    global _model_list, _model_list_at
+    import google.generativeai as genai
+
+    with _model_lock:
+        if not refresh and _model_list is not None and time.monotonic() - _model_list_at < AI_MODEL_LIST_TTL_S:
+            return _model_list
+    request_options = {"timeout": timeout} if timeout else None
+    models = [m.name for m in genai.list_models(request_options=request_options) if 'generateContent' in m.supported_generation_methods]
+    with _model_lock:
+        _model_list, _model_list_at = models, time.monotonic()
+    return models
+
+def candidate_models() -> List[str]:
+    """The last working model, then MODELS_TO_TRY with the ones the account lists first."""
+    with _model_lock:
+        working, available = _working_model, _model_list
+    candidates = MODELS_TO_TRY
+    if available:
+        names = {name.rsplit("/", 1)[-1] for name in available}
+        candidates = [m for m in MODELS_TO_TRY if m in names] + [m for m in MODELS_TO_TRY if m not in names]
+    if working:
+        candidates = [working] + [m for m in candidates if m != working]
+    return candidates
+
+def _remember_working_model(model_name: str):
+    global _working_model, _working_model_since
+    with _model_lock:
+        if _working_model != model_name:
+            print(f"Using AI model: {model_name}")
+            _working_model, _working_model_since = model_name, time.monotonic()
+
+def _forget_working_model(model_name: str):
+    # Only the model that failed is forgotten; another chunk may have found a new one meanwhile
+    global _working_model, _working_model_since
+    with _model_lock:
+        if _working_model == model_name:
+            _working_model = _working_model_since = None
+
+def model_status() -> dict:
+    with _model_lock:
+        now = time.monotonic()
+        return {
+            "working_model": _working_model,
+            "working_model_age_s": round(now - _working_model_since, 1) if _working_model_since else None,
+            "available_models": _model_list,
+            "model_list_age_s": round(now - _model_list_at, 1) if _model_list_at else None,
+            "model_list_ttl_s": AI_MODEL_LIST_TTL_S,
+        }
@@ -0,0 +1,177 @@
+"""
+Registry of bank statement layouts.
+
+A BankFormat says how to find a bank's columns and how to read its values.
+It is recognized from the first row of a file: either the exact header row
+(case and spacing ignored) or, for headerless exports, a prefix of the first
+cell. Both are dictionary lookups built once per registry, so detection
+costs the same however many formats are registered.
+
+Built-in formats live in BUILTIN_FORMATS; users add their own header
+mappings through the API (stored in the bank_format table). Files matching
+no format fall back to guessing columns from header names.
+"""
+import csv
+import threading
+from typing import Iterable, List, Optional, Sequence
+
+from sqlmodel import Session, select
+
+from models import BankFormatMapping
+
+class BankFormat:
+    def __init__(self, name: str, date_idx: int, amount_idx: int, desc_idx: int = -1,
+                 header: Optional[Sequence[str]] = None,
+                 first_cell_prefix: Optional[str] = None, min_columns: int = 0,
+                 date_format: Optional[str] = None, decimal_separator: Optional[str] = None,
+                 negative_style: Optional[str] = None, skip_prefixes: Iterable[str] = ()):
+        """
+        header: exact header row identifying the format (the first row is then skipped).
+        first_cell_prefix/min_columns: identify a headerless format by its first data row.
+        date_format, decimal_separator, negative_style: fixed conventions; None means
+        infer them from the file (see importer.py).
+        skip_prefixes: rows whose first cell starts with one of these are not transactions
+        (totals, balances).
+        """
+        self.name = name
+        self.date_idx = date_idx
+        self.desc_idx = desc_idx # -1 when there is no description column
+        self.amount_idx = amount_idx
+        self.header = header_fingerprint(header) if header else None
+        self.first_cell_prefix = first_cell_prefix.upper() if first_cell_prefix else None
+        self.min_columns = min_columns
+        self.date_format = date_format
+        self.decimal_separator = decimal_separator
+        self.negative_style = negative_style
+        self.skip_prefixes = tuple(p.lower() for p in skip_prefixes if p)
+
+    @property
+    def has_header(self) -> bool:
+        return self.first_cell_prefix is None
+
+    def skips(self, row: List[str]) -> bool:
+        return bool(self.skip_prefixes) and bool(row) and row[0].strip().lower().startswith(self.skip_prefixes)
+
+    def to_dict(self) -> dict:
+        return {
+            "name": self.name,
+            "header": list(self.header) if self.header else None,
+            "first_cell_prefix": self.first_cell_prefix,
+            "date_column": self.date_idx,
+            "description_column": self.desc_idx if self.desc_idx != -1 else None,
+            "amount_column": self.amount_idx,
+            "date_format": self.date_format,
+            "decimal_separator": self.decimal_separator,
+            "negative_style": self.negative_style,
+        }
+
+def header_fingerprint(cells: Sequence[str]) -> tuple:
+    return tuple(" ".join(c.lower().split()) for c in cells)
+
+CSV_DELIMITERS = (",", ";", "\t")
+
+def sniff_delimiter(header_line: str) -> str:
+    """
+    Picks the delimiter that splits a header row into the most cells, a comma on ties.
+    csv.Sniffer is not used: on a single row it ties everything and prefers the comma,
+    so "Data;Valor, EUR;Descrição" would come out comma-separated.
+    """
+    header_line = header_line.rstrip("\r\n")
+    return max(CSV_DELIMITERS, key=lambda d: len(next(csv.reader([header_line], delimiter=d), [])))
+
+def parse_header_line(header_line: str) -> List[str]:
+    """Splits a header row as csv.reader would read it from a file, quotes included."""
+    header_line = header_line.rstrip("\r\n")
+    return next(csv.reader([header_line], delimiter=sniff_delimiter(header_line)), [])
+
+BUILTIN_FORMATS = [
+    # "MASTERCARD ...", "", "", Date, Seq, Desc, ..., Amount
+    BankFormat("Mastercard", date_idx=3, desc_idx=5, amount_idx=11,
+               first_cell_prefix="MASTERCARD", min_columns=12),
+]
+
+class BankFormatRegistry:
+    def __init__(self, formats: Iterable[BankFormat]):
+        # Earlier formats win on identical fingerprints, so custom mappings go first
+        self.formats: List[BankFormat] = list(formats)
+        self._by_header = {}
+        self._by_first_word = {}
+        for fmt in self.formats:
+            if fmt.header:
+                self._by_header.setdefault(fmt.header, fmt)
+            else:
+                first_word = fmt.first_cell_prefix.split()[0] if fmt.first_cell_prefix.split() else ""
+                self._by_first_word.setdefault(first_word, []).append(fmt)
+
+    def detect(self, first_row: List[str]) -> Optional[BankFormat]:
+        """Returns the format whose fingerprint matches first_row, or a generic header guess."""
+        fmt = self._by_header.get(header_fingerprint(first_row))
+        if fmt:
+            return fmt
+
+        first_cell = first_row[0].strip().upper() if first_row else ""
+        first_word = first_cell.split()[0] if first_cell.split() else ""
+        for fmt in self._by_first_word.get(first_word, ()):
+            if first_cell.startswith(fmt.first_cell_prefix) and len(first_row) >= fmt.min_columns:
+                return fmt
+
+        return guess_header_format(first_row)
+
+def guess_header_format(first_row: List[str]) -> Optional[BankFormat]:
+    # Fallback for unknown banks: columns named like Date / Description / Amount
+    headers = [h.lower() for h in first_row]
+    date_idx = desc_idx = amount_idx = -1
+    for i, h in enumerate(headers):
+        if 'date' in h: date_idx = i
+        if 'description' in h or 'memo' in h or 'payee' in h or 'details' in h: desc_idx = i
+        if 'amount' in h: amount_idx = i
+    if date_idx == -1 or amount_idx == -1:
+        return None
+    return BankFormat("Generic", date_idx=date_idx, desc_idx=desc_idx, amount_idx=amount_idx, header=first_row)
+
+def format_from_mapping(mapping: BankFormatMapping) -> BankFormat:
+    """Builds a BankFormat from a stored custom mapping (columns are given by header name)."""
+    header = mapping_header(mapping)
+    def column(name: Optional[str]) -> int:
+        return header.index(header_fingerprint([name])[0]) if name else -1
+    return BankFormat(
+        mapping.name,
+        date_idx=column(mapping.date_column),
+        desc_idx=column(mapping.description_column),
+        amount_idx=column(mapping.amount_column),
+        header=header,
+        date_format=mapping.date_format,
+        decimal_separator=mapping.decimal_separator,
+        negative_style=mapping.negative_style,
+        skip_prefixes=[mapping.skip_prefix] if mapping.skip_prefix else (),
+    )
+
+def mapping_header(mapping) -> tuple:
+    # Stored as the file's header row, in the file's own delimiter and quoting
+    return header_fingerprint(parse_header_line(mapping.header))
+
+# --- Process-wide cache ---
+
+_lock = threading.Lock()
+_cached_registry: Optional[BankFormatRegistry] = None
+_generation = 0
+
+def get_format_registry(session: Session) -> BankFormatRegistry:
+    global _cached_registry
+    with _lock:
+        if _cached_registry is not None:
+            return _cached_registry
+        generation = _generation
+    mappings = session.exec(select(BankFormatMapping).order_by(BankFormatMapping.id)).all()
+    registry = BankFormatRegistry([format_from_mapping(m) for m in mappings] + BUILTIN_FORMATS)
+    with _lock:
+        # Only cache if no mapping changed while we were building
+        if generation == _generation:
+            _cached_registry = registry
+    return registry
+
+def invalidate_format_registry():
+    global _cached_registry, _generation
+    with _lock:
+        _cached_registry = None
+        _generation += 1
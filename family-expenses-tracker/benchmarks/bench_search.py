@@ -0,0 +1,79 @@
+"""
+Times GET /transactions/?search= with the trigram FTS5 index against the LIKE scan it replaces.
+
+    python3 benchmarks/bench_search.py [rows]
+
+Builds a throwaway database of `rows` transactions (100,000 by default) through the normal
+migrations, then runs the list query for rare, common and short terms both ways.
+"""
+import os
+import random
+import statistics
+import sys
+import tempfile
+import time
+from datetime import date, timedelta
+
+APP_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, APP_DIR)
+
+from sqlalchemy import event, text
+from sqlmodel import Session, create_engine
+
+import database
+from routers.transactions import _apply_search, _transaction_read_query
+from models import Transaction
+
+MERCHANTS = [
+    "STARBUCKS {n} LISBON", "PINGO DOCE {n}", "CONTINENTE MODELO {n}", "UBER *TRIP {n}", "AMAZON MKTPLACE PMTS",
+    "Netflix.com", "SHELL {n} AUTO", "LIDL {n} PORTO", "IKEA ALFRAGIDE", "Farmacia Central {n}",
+    "Transfer to savings", "Card payment {n} Cafe Nicola", "APPLE.COM/BILL", "Zara {n}", "EDP COMERCIAL",
+]
+TERMS = ["buck", "LIDL", "ikea alfr", "starbucks 4242", "central 7777", "nothing like this", "bu"]
+
+def build(path, rows):
+    engine = create_engine(f"sqlite:///{path}")
+    event.listen(engine, "connect", database._apply_sqlite_pragmas)
+    database.engine = engine
+    database.create_db_and_tables()
+    rng = random.Random(7)
+    start = date(2020, 1, 1)
+    with engine.begin() as conn:
+        conn.execute(text("INSERT INTO user (name) VALUES ('Bench')"))
+        conn.execute(text("INSERT INTO account (name, user_id, is_shared) VALUES ('Bench', 1, 0)"))
+        conn.execute(Transaction.__table__.insert(), [{
+            "date": start + timedelta(days=rng.randrange(2000)),
+            "amount": -round(rng.uniform(1, 200), 2),
+            "description": rng.choice(MERCHANTS).format(n=rng.randrange(10000)),
+            "category_id": 1, "account_id": 1, "user_id": 1, "is_family": False, "category_manual": False,
+        } for _ in range(rows)])
+    return engine
+
+def timed(engine, term, fts, repeat=5):
+    database.FTS_ENABLED = fts
+    query = _apply_search(_transaction_read_query(), term)
+    query = query.order_by(Transaction.date.desc(), Transaction.id.desc()).limit(100)
+    samples = []
+    with Session(engine) as session:
+        for _ in range(repeat):
+            began = time.perf_counter()
+            found = len(session.exec(query).all())
+            samples.append(time.perf_counter() - began)
+    return statistics.median(samples) * 1000, found
+
+def main():
+    rows = int(sys.argv[1]) if len(sys.argv) > 1 else 100_000
+    with tempfile.TemporaryDirectory() as tmp:
+        engine = build(os.path.join(tmp, "bench.db"), rows)
+        trigram = database.FTS_ENABLED
+        print(f"{rows} transactions, trigram index: {trigram}")
+        print(f"{'term':<20}{'LIKE ms':>10}{'FTS ms':>10}{'rows':>7}")
+        for term in TERMS:
+            like_ms, like_found = timed(engine, term, False)
+            fts_ms, fts_found = timed(engine, term, trigram)
+            assert like_found == fts_found, (term, like_found, fts_found)
+            print(f"{term!r:<20}{like_ms:>10.1f}{fts_ms:>10.1f}{fts_found:>7}")
+        engine.dispose()
+
+if __name__ == "__main__":
+    main()
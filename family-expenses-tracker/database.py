@@ -1,4 +1,6 @@
 from sqlmodel import SQLModel, create_engine, Session, select
+from sqlalchemy import event
+import json
 import os
 
 # Home Assistant addon data directory or local fallback
@@ -6,154 +8,276 @@ DATA_DIR = "/data" if os.path.isdir("/data") else "."
 DB_NAME = "expenses.db"
 DATABASE_URL = f"sqlite:///{os.path.join(DATA_DIR, DB_NAME)}"
 
+# Tuning defaults, overridable from the add-on options (config.yaml)
+DEFAULT_OPTIONS = {
+    "sqlite_cache_size_mb": 16,
+    "sqlite_mmap_size_mb": 64,
+    "sqlite_busy_timeout_ms": 5000,
+    # AI categorisation: concurrent Gemini calls and the time one chunk may take
+    "ai_max_workers": 3,
+    "ai_chunk_timeout_s": 60,
+}
+
+def load_addon_options() -> dict:
+    # Home Assistant writes the add-on options to /data/options.json
+    options = dict(DEFAULT_OPTIONS)
+    options_path = os.path.join(DATA_DIR, "options.json")
+    if os.path.isfile(options_path):
+        try:
+            with open(options_path) as f:
+                options.update(json.load(f))
+        except Exception as e:
+            print(f"Failed to read add-on options, using defaults: {e}")
+    return options
+
+OPTIONS = load_addon_options()
+
 # check_same_thread=False is needed for SQLite with FastAPI multi-threading
 engine = create_engine(DATABASE_URL, connect_args={"check_same_thread": False})
+
+@event.listens_for(engine, "connect")
+def _apply_sqlite_pragmas(dbapi_connection, connection_record):
+    # Runs for every new pooled connection, not just the first session.
+    # WAL lets dashboard reads proceed while an import is committing.
+    cursor = dbapi_connection.cursor()
+    cursor.execute("PRAGMA journal_mode = WAL")
+    cursor.execute("PRAGMA synchronous = NORMAL")
+    cursor.execute("PRAGMA foreign_keys = ON")
+    # Negative cache_size is in KiB
+    cursor.execute(f"PRAGMA cache_size = {-int(OPTIONS['sqlite_cache_size_mb']) * 1024}")
+    cursor.execute(f"PRAGMA mmap_size = {int(OPTIONS['sqlite_mmap_size_mb']) * 1024 * 1024}")
+    cursor.execute(f"PRAGMA busy_timeout = {int(OPTIONS['sqlite_busy_timeout_ms'])}")
+    cursor.close()
+    # SQLite's lower() only folds ASCII; rule matching in SQL must agree with str.lower() in rule_matcher
+    dbapi_connection.create_function("py_lower", 1, lambda s: s.lower() if s else s, deterministic=True)
+
+def get_effective_pragmas() -> dict:
+    pragmas = ["journal_mode", "synchronous", "foreign_keys", "cache_size", "mmap_size", "busy_timeout"]
+    with engine.connect() as conn:
+        return {p: conn.exec_driver_sql(f"PRAGMA {p}").scalar() for p in pragmas}
 print(f"[DIAGNOSTIC] DATABASE_PATH: {os.path.abspath(os.path.join(DATA_DIR, DB_NAME))}")
 print(f"[DIAGNOSTIC] DATABASE_URL: {DATABASE_URL}")
 
 from sqlalchemy import text
 from sqlalchemy.exc import OperationalError
 
+# Set on startup once the trigram FTS5 index over transaction descriptions is known to exist.
+# False when the SQLite build lacks FTS5 trigram (before 3.34); search then falls back to LIKE.
+FTS_ENABLED = False
+
 def create_db_and_tables():
-    print("[DIAGNOSTIC] create_db_and_tables called")
+    global FTS_ENABLED
     # Ensure models are registered with SQLModel before creating tables
     import models 
-    SQLModel.metadata.create_all(engine)
-    migrate_db()
+    version, FTS_ENABLED = _read_schema_state()
+    if version >= LATEST_SCHEMA_VERSION:
+        # Fast path: one read on every normal boot
+        print(f"Database schema is up to date (v{version})")
+        return
+    migrate_db(version)
     seed_db()
+    _, FTS_ENABLED = _read_schema_state()
 
-def migrate_db():
-    with Session(engine) as session:
-        # Enable Foreign Keys
-        session.exec(text("PRAGMA foreign_keys = ON"))
+def _read_schema_state():
+    # Returns (schema version, whether the trigram transaction_fts exists) in a single query.
+    try:
+        with engine.connect() as conn:
+            row = conn.execute(text("""
+                SELECT version,
+                       EXISTS(SELECT 1 FROM sqlite_master
+                              WHERE type='table' AND name='transaction_fts' AND sql LIKE '%trigram%')
+                FROM schema_version
+            """)).first()
+    except OperationalError:
+        # No schema_version table yet: fresh or pre-versioning database
+        return 0, False
+    return (row[0], bool(row[1])) if row else (0, False)
 
-        # 1. Create User table
-        try:
-            tables = session.exec(text("SELECT name FROM sqlite_master WHERE type='table' AND name='user'")).all()
-            if not tables:
-                session.exec(text("CREATE TABLE IF NOT EXISTS user (id INTEGER PRIMARY KEY AUTOINCREMENT, name TEXT)"))
-                session.commit()
-                print("Migrated: Created user table (Manual)")
-        except Exception as e:
-            print(f"Migration User Failed: {e}")
+def migrate_db(current_version: int = 0):
+    """Applies every migration step newer than current_version, each in its own transaction."""
+    for version, description, apply in MIGRATIONS:
+        if version <= current_version:
+            continue
+        with engine.connect() as conn:
+            # pysqlite does not open transactions for DDL on its own
+            conn.exec_driver_sql("BEGIN IMMEDIATE")
+            try:
+                apply(conn)
+                conn.execute(text("CREATE TABLE IF NOT EXISTS schema_version (version INTEGER NOT NULL)"))
+                conn.execute(text("DELETE FROM schema_version"))
+                conn.execute(text("INSERT INTO schema_version (version) VALUES (:version)"), {"version": version})
+                conn.commit()
+            except Exception as e:
+                conn.rollback()
+                print(f"Migration v{version} ({description}) Failed: {e}")
+                raise
+        print(f"Migrated: v{version} {description}")
 
-        # 2. Create Category table
-        try:
-            tables = session.exec(text("SELECT name FROM sqlite_master WHERE type='table' AND name='category'")).all()
-            if not tables:
-                session.exec(text("CREATE TABLE IF NOT EXISTS category (id INTEGER PRIMARY KEY AUTOINCREMENT, name TEXT, icon TEXT, parent_id INTEGER, FOREIGN KEY(parent_id) REFERENCES category(id))"))
-                session.commit()
-                print("Migrated: Created category table (Manual)")
-        except Exception as e:
-            print(f"Migration Category Failed: {e}")
+# --- Migration steps ---
+# Append new steps with the next version number; never edit a released step.
 
-        # 3. Create Trip table
-        try:
-            tables = session.exec(text("SELECT name FROM sqlite_master WHERE type='table' AND name='trip'")).all()
-            if not tables:
-                session.exec(text("CREATE TABLE IF NOT EXISTS trip (id INTEGER PRIMARY KEY AUTOINCREMENT, name TEXT)"))
-                session.commit()
-                print("Migrated: Created trip table (Manual)")
-        except Exception as e:
-            print(f"Migration Trip Failed: {e}")
+def _migration_baseline(conn):
+    SQLModel.metadata.create_all(conn)
 
-        # 4. Create Account table
-        try:
-            tables = session.exec(text("SELECT name FROM sqlite_master WHERE type='table' AND name='account'")).all()
-            if not tables:
-                session.exec(text("CREATE TABLE IF NOT EXISTS account (id INTEGER PRIMARY KEY AUTOINCREMENT, name TEXT, user_id INTEGER, is_shared BOOLEAN DEFAULT 0, FOREIGN KEY(user_id) REFERENCES user(id))"))
-                session.commit()
-                print("Migrated: Created account table (Manual)")
-        except Exception as e:
-            print(f"Migration Account Failed: {e}")
+    # Alterations for databases created before these columns existed
+    def column_names(table):
+        return [c.name for c in conn.execute(text(f"PRAGMA table_info('{table}')")).all()]
 
-        # 5. Create Transaction table
-        try:
-            tables = session.exec(text("SELECT name FROM sqlite_master WHERE type='table' AND name='transaction'")).all()
-            if not tables:
-                session.exec(text("""
-                    CREATE TABLE IF NOT EXISTS "transaction" (
-                        id INTEGER PRIMARY KEY AUTOINCREMENT, 
-                        date DATE, 
-                        amount FLOAT, 
-                        description TEXT, 
-                        category_id INTEGER, 
-                        account_id INTEGER, 
-                        user_id INTEGER, 
-                        trip_id INTEGER, 
-                        is_family BOOLEAN DEFAULT 0,
-                        FOREIGN KEY(category_id) REFERENCES category(id),
-                        FOREIGN KEY(account_id) REFERENCES account(id),
-                        FOREIGN KEY(user_id) REFERENCES user(id),
-                        FOREIGN KEY(trip_id) REFERENCES trip(id)
-                    )
-                """))
-                session.commit()
-                print("Migrated: Created transaction table (Manual)")
-        except Exception as e:
-            print(f"Migration Transaction Failed: {e}")
+    if 'parent_id' not in column_names('category'):
+        conn.execute(text("ALTER TABLE category ADD COLUMN parent_id INTEGER"))
+    if 'is_shared' not in column_names('account'):
+        conn.execute(text("ALTER TABLE account ADD COLUMN is_shared BOOLEAN DEFAULT 0"))
+    transaction_columns = column_names('transaction')
+    if 'is_family' not in transaction_columns:
+        conn.execute(text("ALTER TABLE 'transaction' ADD COLUMN is_family BOOLEAN DEFAULT 0"))
+    if 'trip_id' not in transaction_columns:
+        conn.execute(text("ALTER TABLE 'transaction' ADD COLUMN trip_id INTEGER"))
 
-        # 6. Create Setting table
-        try:
-            tables = session.exec(text("SELECT name FROM sqlite_master WHERE type='table' AND name='setting'")).all()
-            if not tables:
-                session.exec(text("CREATE TABLE IF NOT EXISTS setting (key TEXT PRIMARY KEY, value TEXT)"))
-                session.commit()
-                print("Migrated: Created setting table (Manual)")
-        except Exception as e:
-            print(f"Migration Setting Failed: {e}")
+def _migration_transaction_indexes(conn):
+    # Transaction indexes declared in models.Transaction.__table_args__ as of v2.
+    # Indexes on columns added by later steps are created by those steps.
+    from models import Transaction
+    names = {
+        "ix_transaction_date_id", "ix_transaction_account_date", "ix_transaction_category_date",
+        "ix_transaction_trip", "ix_transaction_user_date", "ix_transaction_family_date",
+    }
+    for index in Transaction.__table__.indexes:
+        if index.name in names:
+            index.create(conn, checkfirst=True)
 
-        # 7. Create ImportRule table
-        try:
-            tables = session.exec(text("SELECT name FROM sqlite_master WHERE type='table' AND name='importrule'")).all()
-            if not tables:
-                session.exec(text("CREATE TABLE IF NOT EXISTS importrule (id INTEGER PRIMARY KEY AUTOINCREMENT, pattern TEXT NOT NULL, category_id INTEGER NOT NULL, FOREIGN KEY(category_id) REFERENCES category(id))"))
-                session.commit()
-                print("Migrated: Created importrule table (Manual)")
-        except Exception as e:
-            print(f"Migration ImportRule Failed: {e}")
+def _migration_transaction_fts(conn):
+    # FTS5 index over transaction.description, kept in sync by triggers
+    try:
+        conn.execute(text("""
+            CREATE VIRTUAL TABLE IF NOT EXISTS transaction_fts USING fts5(
+                description, content='transaction', content_rowid='id'
+            )
+        """))
+    except OperationalError as e:
+        print(f"FTS5 unavailable, transaction search will use LIKE: {e}")
+        return
+    conn.execute(text("""
+        CREATE TRIGGER IF NOT EXISTS transaction_fts_ai AFTER INSERT ON "transaction" BEGIN
+            INSERT INTO transaction_fts(rowid, description) VALUES (new.id, new.description);
+        END
+    """))
+    conn.execute(text("""
+        CREATE TRIGGER IF NOT EXISTS transaction_fts_ad AFTER DELETE ON "transaction" BEGIN
+            INSERT INTO transaction_fts(transaction_fts, rowid, description) VALUES ('delete', old.id, old.description);
+        END
+    """))
+    conn.execute(text("""
+        CREATE TRIGGER IF NOT EXISTS transaction_fts_au AFTER UPDATE OF description ON "transaction" BEGIN
+            INSERT INTO transaction_fts(transaction_fts, rowid, description) VALUES ('delete', old.id, old.description);
+            INSERT INTO transaction_fts(rowid, description) VALUES (new.id, new.description);
+        END
+    """))
+    # One-time backfill of the rows that existed before the index
+    conn.execute(text("INSERT INTO transaction_fts(transaction_fts) VALUES ('rebuild')"))
 
-        # --- Alterations for existing tables (Backwards Compatibility) ---
+def _migration_monthly_rollup(conn):
+    from models import MonthlyRollup
+    from rollup import create_rollup_triggers, rebuild_monthly_rollup
+    MonthlyRollup.__table__.create(conn, checkfirst=True)
+    create_rollup_triggers(conn)
+    rebuild_monthly_rollup(conn)
 
-        # Add parent_id to category if missing
-        try:
-            columns = session.exec(text("PRAGMA table_info(category)")).all()
-            if columns:
-                col_names = [c.name for c in columns]
-                if 'parent_id' not in col_names:
-                    session.exec(text("ALTER TABLE category ADD COLUMN parent_id INTEGER"))
-                    session.commit()
-                    print("Migrated: Added parent_id to category")
-        except Exception as e:
-            print(f"Migration Alter Category Failed: {e}")
+def _migration_transaction_category_manual(conn):
+    columns = [c.name for c in conn.execute(text("PRAGMA table_info('transaction')")).all()]
+    if 'category_manual' not in columns:
+        conn.execute(text("ALTER TABLE 'transaction' ADD COLUMN category_manual BOOLEAN NOT NULL DEFAULT 0"))
 
-        # Add is_shared to account if missing
-        try:
-            columns = session.exec(text("PRAGMA table_info(account)")).all()
-            if columns:
-                col_names = [c.name for c in columns]
-                if 'is_shared' not in col_names:
-                    session.exec(text("ALTER TABLE account ADD COLUMN is_shared BOOLEAN DEFAULT 0"))
-                    session.commit()
-                    print("Migrated: Added is_shared to account")
-        except Exception as e:
-            print(f"Migration Alter Account Failed: {e}")
+def _migration_transaction_fingerprint(conn):
+    from importer import fingerprint_key, transaction_fingerprint
+    columns = [c.name for c in conn.execute(text("PRAGMA table_info('transaction')")).all()]
+    if 'fingerprint' not in columns:
+        conn.execute(text("ALTER TABLE 'transaction' ADD COLUMN fingerprint TEXT"))
 
-        # Add is_family and trip_id to transaction if missing
-        try:
-            columns = session.exec(text("PRAGMA table_info('transaction')")).all()
-            if columns:
-                col_names = [c.name for c in columns]
-                if 'is_family' not in col_names:
-                    session.exec(text("ALTER TABLE 'transaction' ADD COLUMN is_family BOOLEAN DEFAULT 0"))
-                    session.commit()
-                    print("Migrated: Added is_family to transaction")
-                if 'trip_id' not in col_names:
-                    session.exec(text("ALTER TABLE 'transaction' ADD COLUMN trip_id INTEGER"))
-                    session.commit()
-                    print("Migrated: Added trip_id to transaction")
-        except Exception as e:
-            print(f"Migration Alter Transaction Failed: {e}")
+    # Backfill existing rows so re-importing an old statement skips them.
+    # Occurrences of identical rows are numbered in id order, as an import numbers them in file order.
+    occurrences = {}
+    updates = []
+    rows = conn.execute(text('SELECT id, account_id, date, amount, description FROM "transaction" WHERE fingerprint IS NULL ORDER BY id'))
+    for tx_id, account_id, tx_date, amount, description in rows.all():
+        key = fingerprint_key(account_id, tx_date, amount, description)
+        occurrence = occurrences.get(key, 0)
+        occurrences[key] = occurrence + 1
+        updates.append({"tx_id": tx_id, "fingerprint": transaction_fingerprint(key, occurrence)})
+    if updates:
+        conn.execute(text('UPDATE "transaction" SET fingerprint = :fingerprint WHERE id = :tx_id'), updates)
+    conn.execute(text('CREATE UNIQUE INDEX IF NOT EXISTS ux_transaction_fingerprint ON "transaction" (fingerprint)'))
+
+def _migration_import_batches(conn):
+    from models import ImportBatch
+    ImportBatch.__table__.create(conn, checkfirst=True)
+    columns = [c.name for c in conn.execute(text("PRAGMA table_info('transaction')")).all()]
+    if 'batch_id' not in columns:
+        conn.execute(text("ALTER TABLE 'transaction' ADD COLUMN batch_id INTEGER REFERENCES import_batch(id)"))
+    conn.execute(text('CREATE INDEX IF NOT EXISTS ix_transaction_batch ON "transaction" (batch_id)'))
+
+def _migration_bank_formats(conn):
+    from models import BankFormatMapping
+    BankFormatMapping.__table__.create(conn, checkfirst=True)
+
+def _migration_ai_category_cache(conn):
+    from models import AICategoryCache
+    AICategoryCache.__table__.create(conn, checkfirst=True)
+
+def _migration_transaction_fts_trigram(conn):
+    # v3 indexed words, so search could only match word prefixes ("buck" missed "STARBUCKS").
+    # A trigram index answers the substring search LIKE '%term%' did, for terms of 3+ characters.
+    try:
+        conn.execute(text("CREATE VIRTUAL TABLE temp.trigram_probe USING fts5(x, tokenize='trigram')"))
+        conn.execute(text("DROP TABLE temp.trigram_probe"))
+    except OperationalError as e:
+        print(f"FTS5 trigram unavailable, transaction search will use LIKE: {e}")
+        trigram = False
+    else:
+        trigram = True
+
+    # The word index no longer serves search; drop it either way so writes stop maintaining it
+    for trigger in ("transaction_fts_ai", "transaction_fts_ad", "transaction_fts_au"):
+        conn.execute(text(f"DROP TRIGGER IF EXISTS {trigger}"))
+    conn.execute(text("DROP TABLE IF EXISTS transaction_fts"))
+    if not trigram:
+        return
+
+    conn.execute(text("""
+        CREATE VIRTUAL TABLE transaction_fts USING fts5(
+            description, content='transaction', content_rowid='id', tokenize='trigram'
+        )
+    """))
+    conn.execute(text("""
+        CREATE TRIGGER transaction_fts_ai AFTER INSERT ON "transaction" BEGIN
+            INSERT INTO transaction_fts(rowid, description) VALUES (new.id, new.description);
+        END
+    """))
+    conn.execute(text("""
+        CREATE TRIGGER transaction_fts_ad AFTER DELETE ON "transaction" BEGIN
+            INSERT INTO transaction_fts(transaction_fts, rowid, description) VALUES ('delete', old.id, old.description);
+        END
+    """))
+    conn.execute(text("""
+        CREATE TRIGGER transaction_fts_au AFTER UPDATE OF description ON "transaction" BEGIN
+            INSERT INTO transaction_fts(transaction_fts, rowid, description) VALUES ('delete', old.id, old.description);
+            INSERT INTO transaction_fts(rowid, description) VALUES (new.id, new.description);
+        END
+    """))
+    conn.execute(text("INSERT INTO transaction_fts(transaction_fts) VALUES ('rebuild')"))
+
+MIGRATIONS = [
+    (1, "Baseline schema", _migration_baseline),
+    (2, "Transaction indexes", _migration_transaction_indexes),
+    (3, "Transaction full-text search", _migration_transaction_fts),
+    (4, "Monthly spending rollup", _migration_monthly_rollup),
+    (5, "Transaction manual category flag", _migration_transaction_category_manual),
+    (6, "Transaction import fingerprint", _migration_transaction_fingerprint),
+    (7, "Import batches", _migration_import_batches),
+    (8, "Custom bank formats", _migration_bank_formats),
+    (9, "AI categorisation cache", _migration_ai_category_cache),
+    (10, "Substring search index", _migration_transaction_fts_trigram),
+]
+LATEST_SCHEMA_VERSION = MIGRATIONS[-1][0]
 
 def seed_db():
     from models import Category
@@ -0,0 +1,103 @@
+"""
+In-process background jobs with progress reporting.
+
+Jobs run on a small thread pool so long operations (rule re-application,
+large imports) never hold an HTTP request open. Status lives in memory and
+is lost on restart, which is fine for progress polling.
+"""
+import threading
+import time
+import traceback
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from typing import Callable, Dict, Optional
+
+# Few workers: SQLite has a single writer, and interactive requests must not starve
+MAX_WORKERS = 2
+# Finished jobs kept for status polling
+MAX_FINISHED_JOBS = 50
+
+_executor = ThreadPoolExecutor(max_workers=MAX_WORKERS, thread_name_prefix="job")
+_lock = threading.Lock()
+_jobs: Dict[str, "Job"] = {}
+
+class Job:
+    def __init__(self, kind: str):
+        self.id = uuid.uuid4().hex
+        self.kind = kind
+        self.status = "queued" # queued, running, done, failed
+        self.total: Optional[int] = None
+        self.processed = 0
+        self.created_at = time.time()
+        self.started_at: Optional[float] = None
+        self.finished_at: Optional[float] = None
+        self.error: Optional[str] = None
+        self.result: Optional[dict] = None
+
+    def to_dict(self) -> dict:
+        now = self.finished_at or time.time()
+        elapsed = now - self.started_at if self.started_at else 0.0
+        rate = self.processed / elapsed if elapsed > 0 else None
+        eta = None
+        if self.status == "running" and rate and self.total is not None:
+            eta = round(max(self.total - self.processed, 0) / rate, 1)
+        return {
+            "id": self.id,
+            "kind": self.kind,
+            "status": self.status,
+            "total": self.total,
+            "processed": self.processed,
+            "progress": round(self.processed / self.total, 3) if self.total else None,
+            "elapsed_seconds": round(elapsed, 2),
+            "rows_per_second": round(rate, 1) if rate else None,
+            "eta_seconds": eta,
+            "error": self.error,
+            "result": self.result,
+        }
+
+def start_job(kind: str, work: Callable[[Job], Optional[dict]], total: Optional[int] = None) -> Job:
+    """
+    Queues work(job) on the pool. work updates job.total/processed and returns the result.
+    total: a size already known to the caller, set before the work can start.
+    """
+    job = Job(kind)
+    job.total = total
+    with _lock:
+        _jobs[job.id] = job
+        _prune_finished()
+    _executor.submit(_run, job, work)
+    return job
+
+def get_job(job_id: str) -> Optional[Job]:
+    return _jobs.get(job_id)
+
+def find_active_job(kind: str) -> Optional[Job]:
+    with _lock:
+        for job in _jobs.values():
+            if job.kind == kind and job.status in ("queued", "running"):
+                return job
+    return None
+
+def list_jobs(kind: Optional[str] = None) -> list:
+    with _lock:
+        jobs = [j for j in _jobs.values() if kind is None or j.kind == kind]
+    return sorted(jobs, key=lambda j: j.created_at, reverse=True)
+
+def _run(job: Job, work: Callable[[Job], Optional[dict]]):
+    job.status = "running"
+    job.started_at = time.time()
+    try:
+        job.result = work(job)
+        job.status = "done"
+    except Exception as e:
+        traceback.print_exc()
+        job.error = str(e)
+        job.status = "failed"
+    finally:
+        job.finished_at = time.time()
+
+def _prune_finished():
+    finished = [j for j in _jobs.values() if j.status in ("done", "failed")]
+    finished.sort(key=lambda j: j.created_at)
+    for job in finished[:max(len(finished) - MAX_FINISHED_JOBS, 0)]:
+        del _jobs[job.id]
@@ -1,6 +1,8 @@
 from typing import Optional, List
 from sqlmodel import Field, SQLModel, Relationship, text
-from datetime import date
+from sqlalchemy import Index
+from datetime import date, datetime, timezone
+import datetime as dt
 
 # User (Family Member)
 class UserBase(SQLModel):
@@ -94,7 +96,32 @@ class TransactionBase(SQLModel):
     is_family: bool = False
 
 class Transaction(TransactionBase, table=True):
+    # Managed index set, also created on existing databases by migrate_db.
+    # ix_transaction_date_id doubles as the plain (date) index for date-range scans.
+    __table_args__ = (
+        # Matches the (date DESC, id DESC) keyset pagination of /transactions/
+        Index("ix_transaction_date_id", "date", "id"),
+        # /transactions/ filters
+        Index("ix_transaction_account_date", "account_id", "date"),
+        Index("ix_transaction_category_date", "category_id", "date"),
+        Index("ix_transaction_trip", "trip_id"),
+        # /stats/dashboard scopes
+        Index("ix_transaction_user_date", "user_id", "date"),
+        Index("ix_transaction_family_date", "is_family", "date"),
+        # Duplicate detection on re-import; NULL (hand-entered rows) never collides
+        Index("ux_transaction_fingerprint", "fingerprint", unique=True),
+        # Undo of a whole import batch
+        Index("ix_transaction_batch", "batch_id"),
+    )
+
     id: Optional[int] = Field(default=None, primary_key=True)
+    # True once a person picked the category; rule re-application skips these rows
+    category_manual: bool = Field(default=False, sa_column_kwargs={"server_default": text("0")})
+    # Set for imported rows, see importer.transaction_fingerprint.
+    # Rows that existed at schema v6 were backfilled, so this does not tell imported rows apart; batch_id does.
+    fingerprint: Optional[str] = None
+    # Import that created the row, None for hand-entered rows
+    batch_id: Optional[int] = Field(default=None, foreign_key="import_batch.id")
     
     # Relationships
     category: Optional["Category"] = Relationship()
@@ -106,7 +133,8 @@ class TransactionCreate(TransactionBase):
     pass
 
 class TransactionUpdate(SQLModel):
-    date: Optional[date] = None
+    # dt.date: inside the class body a bare `date` resolves to this field's own default (None)
+    date: Optional[dt.date] = None
     amount: Optional[float] = None
     description: Optional[str] = None
     category_id: Optional[int] = None
@@ -123,6 +151,82 @@ class TransactionRead(TransactionBase):
     trip_name: Optional[str] = None
 
 
+# Import Batches (one per uploaded statement, undoable as a whole)
+class ImportBatch(SQLModel, table=True):
+    __tablename__ = "import_batch"
+
+    id: Optional[int] = Field(default=None, primary_key=True)
+    file_name: Optional[str] = None
+    account_id: int = Field(foreign_key="account.id")
+    created_at: datetime = Field(default_factory=lambda: datetime.now(timezone.utc))
+    row_count: int = 0 # inserted rows
+    skipped_count: int = 0
+    elapsed_seconds: Optional[float] = None
+
+class ImportBatchRead(SQLModel):
+    id: int
+    file_name: Optional[str] = None
+    account_id: int
+    account_name: Optional[str] = None
+    created_at: datetime
+    row_count: int
+    skipped_count: int
+    elapsed_seconds: Optional[float] = None
+
+
+# Monthly spending rollup, maintained by triggers on "transaction" (see rollup.py).
+# Key columns use 0 instead of NULL so every combination has exactly one row.
+class MonthlyRollup(SQLModel, table=True):
+    __tablename__ = "monthly_rollup"
+    __table_args__ = (
+        Index("ix_monthly_rollup_trip", "trip_id"),
+    )
+
+    year: int = Field(primary_key=True)
+    month: int = Field(primary_key=True)
+    category_id: int = Field(default=0, primary_key=True)
+    user_id: int = Field(default=0, primary_key=True)
+    is_family: bool = Field(default=False, primary_key=True)
+    trip_id: int = Field(default=0, primary_key=True)
+    total: float = 0.0
+    tx_count: int = 0
+
+
+# Custom bank statement layouts (see bank_formats.py)
+class BankFormatMappingBase(SQLModel):
+    name: str
+    header: str # the file's header row as it appears in the file (comma, semicolon or tab)
+    date_column: str # header names of the mapped columns
+    amount_column: str
+    description_column: Optional[str] = None
+    date_format: Optional[str] = None # None: inferred per file
+    decimal_separator: Optional[str] = None
+    negative_style: Optional[str] = None # leading, trailing or parentheses
+    skip_prefix: Optional[str] = None # rows whose first cell starts with this are skipped
+
+class BankFormatMapping(BankFormatMappingBase, table=True):
+    __tablename__ = "bank_format"
+
+    id: Optional[int] = Field(default=None, primary_key=True)
+
+class BankFormatMappingCreate(BankFormatMappingBase):
+    pass
+
+class BankFormatMappingRead(BankFormatMappingBase):
+    id: int
+
+
+# AI categorisation cache: one answer per normalized merchant (see ai_categorizer.merchant_key)
+class AICategoryCache(SQLModel, table=True):
+    __tablename__ = "ai_category_cache"
+
+    merchant_key: str = Field(primary_key=True)
+    category_id: int = Field(foreign_key="category.id", index=True)
+    rule_pattern: Optional[str] = None
+    confidence: Optional[float] = None
+    updated_at: datetime = Field(default_factory=lambda: datetime.now(timezone.utc))
+
+
 # Import Rules
 class ImportRuleBase(SQLModel):
     pattern: str  # Keywords to match in description
@@ -139,6 +243,7 @@ class ImportRuleCreate(ImportRuleBase):
 class ImportRuleRead(ImportRuleBase):
     id: int
     category_name: Optional[str] = None
+    applied_count: Optional[int] = None # Set when a rule is created and applied retroactively
 
 class ImportRuleUpdate(SQLModel):
     pattern: Optional[str] = None
@@ -0,0 +1,89 @@
+"""
+Incrementally maintained monthly spending rollup.
+
+Triggers on "transaction" add/subtract each row into monthly_rollup, so every
+write path (API, CSV import, raw bulk statements) keeps it current. The
+dashboard and trip stats read from it instead of scanning the ledger.
+"""
+from sqlalchemy import text
+
+ROLLUP_KEY_COLUMNS = "year, month, category_id, user_id, is_family, trip_id"
+
+def _key_values(row: str) -> str:
+    return (
+        f"CAST(strftime('%Y', {row}.date) AS INTEGER), CAST(strftime('%m', {row}.date) AS INTEGER), "
+        f"COALESCE({row}.category_id, 0), COALESCE({row}.user_id, 0), "
+        f"COALESCE({row}.is_family, 0), COALESCE({row}.trip_id, 0)"
+    )
+
+def _add(row: str) -> str:
+    return f"""
+        INSERT INTO monthly_rollup ({ROLLUP_KEY_COLUMNS}, total, tx_count)
+        VALUES ({_key_values(row)}, {row}.amount, 1)
+        ON CONFLICT ({ROLLUP_KEY_COLUMNS})
+        DO UPDATE SET total = total + excluded.total, tx_count = tx_count + 1;
+    """
+
+def _subtract(row: str) -> str:
+    return f"""
+        UPDATE monthly_rollup SET total = total - {row}.amount, tx_count = tx_count - 1
+        WHERE ({ROLLUP_KEY_COLUMNS}) = ({_key_values(row)});
+        DELETE FROM monthly_rollup
+        WHERE ({ROLLUP_KEY_COLUMNS}) = ({_key_values(row)}) AND tx_count <= 0;
+    """
+
+def create_rollup_triggers(conn):
+    conn.execute(text(f"""
+        CREATE TRIGGER IF NOT EXISTS monthly_rollup_ai AFTER INSERT ON "transaction" BEGIN
+            {_add("new")}
+        END
+    """))
+    conn.execute(text(f"""
+        CREATE TRIGGER IF NOT EXISTS monthly_rollup_ad AFTER DELETE ON "transaction" BEGIN
+            {_subtract("old")}
+        END
+    """))
+    conn.execute(text(f"""
+        CREATE TRIGGER IF NOT EXISTS monthly_rollup_au
+        AFTER UPDATE OF date, amount, category_id, user_id, is_family, trip_id ON "transaction" BEGIN
+            {_subtract("old")}
+            {_add("new")}
+        END
+    """))
+
+_RAW_ROLLUP_SELECT = f"""
+    SELECT {_key_values('t')}, SUM(t.amount), COUNT(*)
+    FROM "transaction" t
+    GROUP BY 1, 2, 3, 4, 5, 6
+"""
+
+def rebuild_monthly_rollup(conn) -> int:
+    """Regenerates monthly_rollup from scratch. Returns the number of rollup rows."""
+    conn.execute(text("DELETE FROM monthly_rollup"))
+    conn.execute(text(f"INSERT INTO monthly_rollup ({ROLLUP_KEY_COLUMNS}, total, tx_count) {_RAW_ROLLUP_SELECT}"))
+    return conn.execute(text("SELECT COUNT(*) FROM monthly_rollup")).scalar()
+
+def check_monthly_rollup(conn, tolerance: float = 0.005) -> list:
+    """Compares monthly_rollup against raw SUMs over "transaction". Returns mismatching keys."""
+    raw = {tuple(r[:6]): (r[6], r[7]) for r in conn.execute(text(_RAW_ROLLUP_SELECT)).all()}
+    stored = {
+        tuple(r[:6]): (r[6], r[7])
+        for r in conn.execute(text(f"SELECT {ROLLUP_KEY_COLUMNS}, total, tx_count FROM monthly_rollup")).all()
+    }
+    mismatches = []
+    for key in raw.keys() | stored.keys():
+        raw_total, raw_count = raw.get(key, (0.0, 0))
+        stored_total, stored_count = stored.get(key, (0.0, 0))
+        if raw_count != stored_count or abs(raw_total - stored_total) > tolerance:
+            mismatches.append({
+                "key": dict(zip(["year", "month", "category_id", "user_id", "is_family", "trip_id"], key)),
+                "raw_total": raw_total, "rollup_total": stored_total,
+                "raw_count": raw_count, "rollup_count": stored_count,
+            })
+    return mismatches
+
+if __name__ == "__main__":
+    # Manual rebuild: python3 rollup.py
+    from database import engine
+    with engine.begin() as conn:
+        print(f"Rebuilt monthly_rollup: {rebuild_monthly_rollup(conn)} rows")
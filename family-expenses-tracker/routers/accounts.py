@@ -1,4 +1,5 @@
 from fastapi import APIRouter, Depends, HTTPException
+from sqlalchemy.exc import IntegrityError
 from sqlmodel import Session, select
 from typing import List
 
@@ -46,7 +47,11 @@ def delete_account(account_id: int, session: Session = Depends(get_session)):
     if not account:
         raise HTTPException(status_code=404, detail="Account not found")
     session.delete(account)
-    session.commit()
+    try:
+        session.commit()
+    except IntegrityError:
+        session.rollback()
+        raise HTTPException(status_code=409, detail="Account still has transactions. Delete or move them first.")
     return {"ok": True}
 
 @router.put("/{account_id}", response_model=AccountRead)
@@ -1,9 +1,10 @@
 from fastapi import APIRouter, Depends, HTTPException
-from sqlmodel import Session, select
+from sqlalchemy.exc import IntegrityError
+from sqlmodel import Session, select, delete
 from typing import List
 
 from database import get_session
-from models import Category, CategoryCreate, CategoryRead
+from models import Category, CategoryCreate, CategoryRead, AICategoryCache
 
 router = APIRouter(prefix="/categories", tags=["categories"])
 
@@ -25,8 +26,15 @@ def delete_category(category_id: int, session: Session = Depends(get_session)):
     category = session.get(Category, category_id)
     if not category:
         raise HTTPException(status_code=404, detail="Category not found")
+    # Cached AI answers pointing at this category are no longer valid
+    session.exec(delete(AICategoryCache).where(AICategoryCache.category_id == category_id))
     session.delete(category)
-    session.commit()
+    try:
+        session.commit()
+    except IntegrityError:
+        # Foreign keys are enforced (database.py); referencing rows are not silently orphaned
+        session.rollback()
+        raise HTTPException(status_code=409, detail="Category is still used by transactions, import rules or subcategories. Move them to another category first.")
     return {"ok": True}
 
 @router.put("/{category_id}", response_model=CategoryRead)
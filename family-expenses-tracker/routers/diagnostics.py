@@ -0,0 +1,26 @@
+from fastapi import APIRouter
+
+import ai_categorizer
+import database
+
+router = APIRouter(prefix="/diagnostics", tags=["diagnostics"])
+
+# Filled in by run.py: startup_ms, database_ms, first_request_ms
+STARTUP_TIMINGS = {}
+
+@router.get("/database")
+def read_database_diagnostics():
+    return {
+        "database_url": database.DATABASE_URL,
+        "options": database.OPTIONS,
+        "pragmas": database.get_effective_pragmas(),
+        "fts_enabled": database.FTS_ENABLED,
+    }
+
+@router.get("/startup")
+def read_startup_diagnostics():
+    return STARTUP_TIMINGS
+
+@router.get("/ai")
+def read_ai_diagnostics():
+    return ai_categorizer.model_status()
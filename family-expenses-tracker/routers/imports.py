@@ -1,12 +1,14 @@
 from typing import List, Optional
-from fastapi import APIRouter, Depends, UploadFile, File, HTTPException
-from sqlmodel import Session, select
-import csv
-import codecs
-from datetime import datetime
+from fastapi import APIRouter, Depends, UploadFile, File, HTTPException, Query
+from sqlmodel import Session, select, func, update, delete
+from sqlalchemy import exists
 
-from database import get_session
-from models import ImportRule, ImportRuleCreate, ImportRuleRead, Category, Transaction, TransactionCreate, TransactionRead, Account, ImportRuleUpdate
+from database import get_session, engine
+from jobs import start_job, get_job, find_active_job
+from importer import import_statement, iter_csv_rows, detect_format, import_summary_message, spool_upload, run_import_job, ImportFormatError, BATCH_SIZE, DATE_FORMATS
+from bank_formats import BUILTIN_FORMATS, mapping_header, invalidate_format_registry
+from rule_matcher import invalidate_rule_matcher, reapply_rules_to_ledger
+from models import ImportRule, ImportRuleCreate, ImportRuleRead, Transaction, TransactionCreate, TransactionRead, Account, ImportRuleUpdate, ImportBatch, ImportBatchRead, BankFormatMapping, BankFormatMappingCreate, BankFormatMappingRead
 
 router = APIRouter(prefix="/imports", tags=["imports"])
 
@@ -31,30 +33,162 @@ def create_rule(rule: ImportRuleCreate, session: Session = Depends(get_session))
         session.commit()
         session.refresh(db_rule)
     
-    # 2. Retroactive Application
-    # Find transactions with matching description (case-insensitive substring match)
-    # Note: Using rule.pattern as substring.
-    # We should probably use the same logic as _apply_rules but in SQL/Python.
-    # SQLite LIKE is case-insensitive usually, but let's be safe.
-    # The _apply_rules does: if rule.pattern.lower() in description.lower()
+    invalidate_rule_matcher()
     
-    # We want to find transactions where description contains pattern
-    statement = select(Transaction).where(Transaction.description.contains(db_rule.pattern))
-    matching_txs = session.exec(statement).all()
+    # 2. Retroactive Application, as one set-based UPDATE
+    statement = update(Transaction)\
+        .where(*_rule_application_filters(db_rule.pattern, db_rule.category_id, db_rule.id))\
+        .values(category_id=db_rule.category_id)\
+        .execution_options(synchronize_session=False)
+    applied_count = session.exec(statement).rowcount
+    session.commit()
+
+    response = _populate_rule_read(db_rule, session)
+    response.applied_count = applied_count
+    return response
+
+@router.post("/rules/dry-run")
+def dry_run_rule(rule: ImportRuleCreate, sample_size: int = Query(20, ge=0, le=200), session: Session = Depends(get_session)):
+    """Previews how many transactions a rule would recategorize, without writing anything."""
+    # An existing rule with the same pattern keeps its place in the precedence order
+    existing_rule = session.exec(select(ImportRule).where(ImportRule.pattern == rule.pattern)).first()
+    filters = _rule_application_filters(rule.pattern, rule.category_id, existing_rule.id if existing_rule else None)
     
-    count = 0
-    for tx in matching_txs:
-        # Only update if different? 
-        # User said "apply the rule". So overwrite.
-        if tx.category_id != db_rule.category_id:
-            tx.category_id = db_rule.category_id
-            session.add(tx)
-            count += 1
-            
-    if count > 0:
-        session.commit()
+    count = session.exec(select(func.count(Transaction.id)).where(*filters)).one()
+    sample = session.exec(
+        select(Transaction.id, Transaction.date, Transaction.description, Transaction.amount, Transaction.category_id)
+        .where(*filters).order_by(Transaction.date.desc()).limit(sample_size)
+    ).all()
+    return {
+        "count": count,
+        "sample": [dict(r._mapping) for r in sample]
+    }
 
-    return _populate_rule_read(db_rule, session)
+@router.post("/rules/reapply")
+def reapply_rules():
+    """
+    Re-runs the whole rule set over the ledger in the background.
+    Transactions whose category was set manually are skipped.
+    Poll GET /imports/rules/reapply/{job_id} for progress and ETA.
+    """
+    job = find_active_job("reapply_rules")
+    if not job:
+        job = start_job("reapply_rules", lambda job: reapply_rules_to_ledger(job, engine))
+    return job.to_dict()
+
+@router.get("/rules/reapply/{job_id}")
+def read_reapply_status(job_id: str):
+    job = get_job(job_id)
+    if not job or job.kind != "reapply_rules":
+        raise HTTPException(status_code=404, detail="Job not found")
+    return job.to_dict()
+
+@router.get("/batches", response_model=List[ImportBatchRead])
+def read_import_batches(limit: int = Query(50, ge=1, le=500), session: Session = Depends(get_session)):
+    rows = session.exec(
+        select(ImportBatch, Account.name)
+        .join(Account, ImportBatch.account_id == Account.id, isouter=True)
+        .order_by(ImportBatch.id.desc())
+        .limit(limit)
+    ).all()
+    results = []
+    for batch, account_name in rows:
+        batch_read = ImportBatchRead.model_validate(batch)
+        batch_read.account_name = account_name
+        results.append(batch_read)
+    return results
+
+@router.delete("/batches/{batch_id}")
+def delete_import_batch(batch_id: int, session: Session = Depends(get_session)):
+    """Undoes a whole import. The rollup and search triggers adjust in the same transaction."""
+    batch = session.get(ImportBatch, batch_id)
+    if not batch:
+        raise HTTPException(status_code=404, detail="Import batch not found")
+    deleted = session.exec(
+        delete(Transaction).where(Transaction.batch_id == batch_id).execution_options(synchronize_session=False)
+    ).rowcount
+    session.delete(batch)
+    session.commit()
+    return {"ok": True, "deleted": deleted}
+
+@router.get("/formats")
+def read_bank_formats(session: Session = Depends(get_session)):
+    custom = session.exec(select(BankFormatMapping).order_by(BankFormatMapping.id)).all()
+    return {
+        "builtin": [fmt.to_dict() for fmt in BUILTIN_FORMATS],
+        "custom": custom,
+    }
+
+@router.post("/formats", response_model=BankFormatMappingRead)
+def create_bank_format(mapping: BankFormatMappingCreate, session: Session = Depends(get_session)):
+    """Saves a custom column mapping, recognized on later uploads by its exact header row."""
+    header = mapping_header(mapping)
+    for column in (mapping.date_column, mapping.amount_column, mapping.description_column):
+        if column and " ".join(column.lower().split()) not in header:
+            raise HTTPException(status_code=400, detail=f"Column '{column}' is not in the header")
+    if mapping.date_format and mapping.date_format not in DATE_FORMATS:
+        raise HTTPException(status_code=400, detail=f"Unsupported date format. Supported: {', '.join(DATE_FORMATS)}")
+    if mapping.decimal_separator not in (None, ".", ","):
+        raise HTTPException(status_code=400, detail="decimal_separator must be '.' or ','")
+    if mapping.negative_style not in (None, "leading", "trailing", "parentheses"):
+        raise HTTPException(status_code=400, detail="negative_style must be leading, trailing or parentheses")
+    for existing in session.exec(select(BankFormatMapping)).all():
+        if mapping_header(existing) == header:
+            raise HTTPException(status_code=400, detail=f"Format '{existing.name}' already uses this header")
+
+    db_mapping = BankFormatMapping.model_validate(mapping)
+    session.add(db_mapping)
+    session.commit()
+    session.refresh(db_mapping)
+    invalidate_format_registry()
+    return db_mapping
+
+@router.delete("/formats/{format_id}")
+def delete_bank_format(format_id: int, session: Session = Depends(get_session)):
+    mapping = session.get(BankFormatMapping, format_id)
+    if not mapping:
+        raise HTTPException(status_code=404, detail="Format not found")
+    session.delete(mapping)
+    session.commit()
+    invalidate_format_registry()
+    return {"ok": True}
+
+@router.post("/formats/detect")
+def detect_bank_format(file: UploadFile = File(...), session: Session = Depends(get_session)):
+    """Reports which format an upload would be read with, without importing it."""
+    rows = iter_csv_rows(file.file)
+    try:
+        first_row = next(rows, None)
+    finally:
+        rows.close()
+    if first_row is None:
+        raise HTTPException(status_code=400, detail="File is empty")
+    try:
+        return detect_format(first_row, session).to_dict()
+    except ImportFormatError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+
+def _rule_application_filters(pattern: str, category_id: int, rule_id: Optional[int]):
+    """
+    WHERE clauses selecting the transactions a rule would recategorize:
+    case-insensitive substring match, a different current category, not
+    categorized by hand (as in the reapply job), and no older rule that also
+    matches (older rules win, as in rule_matcher).
+    rule_id None means a rule that does not exist yet, i.e. younger than all.
+    """
+    description = func.py_lower(Transaction.description)
+    older_rules = select(ImportRule.id).where(
+        ImportRule.pattern != "",
+        func.instr(description, func.py_lower(ImportRule.pattern)) > 0
+    )
+    if rule_id is not None:
+        older_rules = older_rules.where(ImportRule.id < rule_id)
+    return [
+        description.contains(pattern.lower(), autoescape=True),
+        Transaction.category_id != category_id,
+        Transaction.category_manual == False,
+        ~exists(older_rules),
+    ]
 
 @router.get("/rules/", response_model=List[ImportRuleRead])
 def read_rules(session: Session = Depends(get_session)):
@@ -68,6 +202,7 @@ def delete_rule(rule_id: int, session: Session = Depends(get_session)):
         raise HTTPException(status_code=404, detail="Rule not found")
     session.delete(rule)
     session.commit()
+    invalidate_rule_matcher()
     return {"ok": True}
 
 @router.put("/rules/{rule_id}", response_model=ImportRuleRead)
@@ -83,19 +218,25 @@ def update_rule(rule_id: int, rule: ImportRuleUpdate, session: Session = Depends
     session.add(db_rule)
     session.commit()
     session.refresh(db_rule)
+    invalidate_rule_matcher()
     return _populate_rule_read(db_rule, session)
 
 
 @router.post("/upload")
-async def upload_csv(
+def upload_csv(
     account_id: int,
     file: UploadFile = File(...),
+    batch_size: int = Query(BATCH_SIZE, ge=1, le=10000),
+    date_format: Optional[str] = Query(None, description="Force a date layout, e.g. %d/%m/%Y, when the file's dates are ambiguous"),
     session: Session = Depends(get_session)
 ):
     """
-    Parses a CSV file and creates transactions.
+    Parses a CSV, OFX/QFX or CAMT.053 statement and creates transactions.
     Auto-categorizes based on rules.
     Expected CSV columns: Date, Description, Amount
+    The file is streamed and bulk-inserted in batches of batch_size rows,
+    all inside one transaction (see importer.py). Date and amount formats
+    are inferred per file; ambiguous dates are rejected unless date_format is given.
     """
     if not account_id:
         raise HTTPException(status_code=400, detail="Account ID required")
@@ -104,147 +245,51 @@ async def upload_csv(
     if not account:
         raise HTTPException(status_code=404, detail="Account not found")
 
-    # Load all rules for matching
-    rules = session.exec(select(ImportRule)).all()
-    
-    # Read file
-    content = await file.read()
-    decoded = content.decode("utf-8-sig") # handle BOM
-    reader = csv.DictReader(codecs.iterdecode(decoded.splitlines(), "utf-8"))
-    
-    # Normalize headers roughly? 
-    # Let's assume standard headers for now or try to detect.
-    # Simple strategy: look for 'date', 'amount', 'description' case-insensitive.
-    
-    transactions_created = 0
-    
-    # We need to map CSV headers to our fields
-    # This is brittle without a mapping UI, but let's try standard names.
-    
-    csv_lines = list(csv.reader(decoded.splitlines()))
-    if not csv_lines:
-        return {"count": 0}
-        
-    headers = [h.lower() for h in csv_lines[0]]
-    
-    # Simple Index detection
     try:
-        date_idx = -1
-        desc_idx = -1
-        amount_idx = -1
-        start_row = 1 # Default to skipping header
-        
-        # Strategy 1: Header names
-        for i, h in enumerate(headers):
-            if 'date' in h: date_idx = i
-            if 'description' in h or 'memo' in h or 'payee' in h or 'details' in h: desc_idx = i
-            if 'amount' in h: amount_idx = i
-            
-        # Strategy 2: Mastercard Headerless or similar known formats
-        if date_idx == -1 or amount_idx == -1:
-             # Check for known signatures in the first row
-             first_cell = csv_lines[0][0].upper() if len(csv_lines[0]) > 0 else ""
-             if "MASTERCARD" in first_cell and len(csv_lines[0]) >= 12:
-                 # Known Mastercard format
-                 # "MASTERCARD ...", "", "", Date, Seq, Desc, ..., Amount
-                 date_idx = 3
-                 desc_idx = 5
-                 amount_idx = 11
-                 start_row = 0 # No header, data starts at row 0
-                 print(f"Detected Mastercard CSV format. Indices: Date={date_idx}, Desc={desc_idx}, Amount={amount_idx}")
-
-        if date_idx == -1 or amount_idx == -1:
-             # Still failed
-             raise HTTPException(status_code=400, detail="Could not detect CSV format. Ensure headers exist (Date, Amount) or use a supported bank format.")
-             
-        # Process rows
-        for row in csv_lines[start_row:]:
-            if len(row) < max(date_idx, desc_idx, amount_idx): continue
-            
-            raw_date = row[date_idx]
-            raw_desc = row[desc_idx] if desc_idx != -1 else "Imported Transaction"
-            raw_amount = row[amount_idx]
-            
-            # Parsing Date
-            # Try formats YYYY-MM-DD, MM/DD/YYYY, etc. 
-            # Very basic parser: assuming ISO or MM/DD/YYYY
-            try:
-                parsed_date = _parse_date(raw_date)
-            except:
-                continue # skip bad dates
-                
-            # Parsing Amount
-            try:
-                # Remove currency symbols, commas
-                clean_amount = raw_amount.replace('$', '').replace(',', '')
-                amount = float(clean_amount)
-            except:
-                continue
-                
-            # Rule Engine
-            category_id = _apply_rules(raw_desc, rules)
-            
-            # Create Transaction
-            # If no category match, what to do? 
-            # Require category_id in DB? Yes.
-            # So either fail or assign "Uncategorized"?
-            # We need a fallback category or allow NULL in DB? Model says category_id is int (required).
-            # Let's find or create "Uncategorized"?
-            # For now, if no category, maybe pick the first one or a default?
-            # Creating a default category if match fails is risky.
-            # Better: Make category_id optional in Transaction?
-            # Or find a category named "Uncategorized" or "General".
-            
-            final_category_id = category_id
-            if not final_category_id:
-                # Fallback: check if "Uncategorized" exists, else create it?
-                # Or just error? users might hate that.
-                # Let's try to find any category.
-                uncat = session.exec(select(Category).where(Category.name == "Uncategorized")).first()
-                if not uncat:
-                    # Create it ?
-                    uncat = Category(name="Uncategorized", icon="❓")
-                    session.add(uncat)
-                    session.commit()
-                    session.refresh(uncat)
-                final_category_id = uncat.id
-
-            transaction = Transaction(
-                date=parsed_date,
-                amount=amount,
-                description=raw_desc,
-                account_id=account_id,
-                category_id=final_category_id,
-                is_family=account.is_shared  # Auto-tag if account is shared
-            )
-            session.add(transaction)
-            transactions_created += 1
-            
+        result = import_statement(file.file, account, session, batch_size=batch_size, file_name=file.filename,
+                            date_format=date_format)
         session.commit()
-        
+    except ImportFormatError as e:
+        session.rollback()
+        raise HTTPException(status_code=400, detail=str(e))
     except Exception as e:
+        session.rollback()
         raise HTTPException(status_code=500, detail=f"Error processing CSV: {str(e)}")
 
-    return {"count": transactions_created, "message": f"Successfully imported {transactions_created} transactions."}
+    result["message"] = import_summary_message(result)
+    return result
+
+@router.post("/jobs")
+def start_import_job(
+    account_id: int,
+    file: UploadFile = File(...),
+    batch_size: int = Query(BATCH_SIZE, ge=1, le=10000),
+    date_format: Optional[str] = Query(None, description="Force a date layout, e.g. %d/%m/%Y, when the file's dates are ambiguous"),
+    session: Session = Depends(get_session)
+):
+    """
+    Background variant of /upload for large statements: the file is spooled
+    to disk and imported by a job worker (see jobs.py, which bounds how many
+    run at once). Poll GET /imports/jobs/{job_id} for progress and the summary.
+    """
+    account = session.get(Account, account_id)
+    if not account:
+        raise HTTPException(status_code=404, detail="Account not found")
 
-def _parse_date(date_str: str) -> datetime.date:
-    # Try multiple formats
-    date_str = date_str.strip()
-    formats = ["%Y-%m-%d", "%m/%d/%Y", "%d/%m/%Y", "%Y/%m/%d"]
-    for fmt in formats:
-        try:
-            return datetime.strptime(date_str, fmt).date()
-        except ValueError:
-            pass
-    raise ValueError("Unknown date format")
+    path, lines = spool_upload(file.file, account_id)
+    file_name = file.filename
+    # total is approximate (one row per line); the worker clears it for OFX/CAMT files
+    job = start_job("import", lambda job: run_import_job(
+        job, engine, path, account_id, file_name, batch_size=batch_size, date_format=date_format
+    ), total=lines)
+    return job.to_dict()
 
-def _apply_rules(description: str, rules: List[ImportRule]) -> Optional[int]:
-    """Returns matching category_id or None"""
-    description_lower = description.lower()
-    for rule in rules:
-        if rule.pattern.lower() in description_lower:
-            return rule.category_id
-    return None
+@router.get("/jobs/{job_id}")
+def read_import_job(job_id: str):
+    job = get_job(job_id)
+    if not job or job.kind != "import":
+        raise HTTPException(status_code=404, detail="Job not found")
+    return job.to_dict()
 
 def _populate_rule_read(rule: ImportRule, session: Session) -> ImportRuleRead:
     category_name = rule.category.name if rule.category else None
@@ -1,56 +1,197 @@
 from typing import List, Optional
-from fastapi import APIRouter, Depends, Query, HTTPException
-from sqlmodel import Session, select, SQLModel
+from fastapi import APIRouter, Depends, Query, HTTPException, Response
+from pydantic import ValidationError
+from sqlmodel import Session, select, SQLModel, tuple_, text
 from datetime import date
+import base64
 
+import database
 from database import get_session
-from models import Transaction, TransactionCreate, TransactionRead, TransactionUpdate, TransactionBase, Category, Account, User
+from rule_matcher import invalidate_rule_matcher
+from ai_categorizer import categorize, merchant_key, lookup_cache, store_cache, list_generation_models, model_status
+from ai_categorizer import configure as configure_ai
+from models import Transaction, TransactionCreate, TransactionRead, TransactionUpdate, TransactionBase, Category, Account, User, Trip
 
 router = APIRouter(prefix="/transactions", tags=["transactions"])
 
 @router.post("/", response_model=TransactionRead)
 def create_transaction(transaction: TransactionCreate, session: Session = Depends(get_session)):
     db_transaction = Transaction.from_orm(transaction)
+    # Entered by hand, so the category was chosen by a person
+    db_transaction.category_manual = True
     session.add(db_transaction)
+    session.flush()
+    # Taken before commit expires the object, which would reload it
+    transaction_id = db_transaction.id
     session.commit()
-    session.refresh(db_transaction)
     
-    # Eager load names for response
-    # Or just construct response manually if lazy loading works
-    # Using TransactionRead, we interpret names. But standard Read model matches Base.
-    # We defined TransactionRead with extra name fields.
-    # We need to populate them.
-    
-    return _populate_transaction_read(db_transaction, session)
+    # Names for the response come from the same joined projection as the list view
+    return _read_transaction_by_id(transaction_id, session)
+
+# Upper bound on operations per /transactions/batch request
+MAX_BATCH_OPERATIONS = 5000
+
+class TransactionBatchOperation(SQLModel):
+    op: str # create, update or delete
+    id: Optional[int] = None # transaction to update or delete
+    data: Optional[dict] = None # TransactionCreate fields for create, TransactionUpdate fields for update
+
+class TransactionBatchRequest(SQLModel):
+    operations: List[TransactionBatchOperation]
+
+@router.post("/batch")
+def batch_transactions(request: TransactionBatchRequest, all_or_nothing: bool = False, session: Session = Depends(get_session)):
+    """
+    Applies many create/update/delete operations in one transaction, using a
+    few set-based statements instead of one request per row.
+    Returns one result per operation, in request order. Invalid operations
+    (bad data, unknown transaction or referenced ids) are reported and
+    skipped; with all_or_nothing they reject the whole batch instead.
+    """
+    operations = request.operations
+    if len(operations) > MAX_BATCH_OPERATIONS:
+        raise HTTPException(status_code=400, detail=f"At most {MAX_BATCH_OPERATIONS} operations per batch")
+    results = [{"index": i, "op": op.op, "id": op.id, "status": "ok"} for i, op in enumerate(operations)]
+
+    # One lookup for every transaction the batch refers to
+    target_ids = {op.id for op in operations if op.id is not None}
+    existing = set(session.exec(select(Transaction.id).where(Transaction.id.in_(target_ids))).all()) if target_ids else set()
+
+    creates = {} # operation index -> row
+    updates = {} # transaction id -> merged changes, later operations win
+    update_indexes = {} # transaction id -> operation indexes
+    deletes = set()
+    for i, op in enumerate(operations):
+        try:
+            if op.op == "create":
+                creates[i] = TransactionCreate.model_validate(op.data or {}).model_dump()
+            elif op.op in ("update", "delete"):
+                if op.id not in existing or op.id in deletes:
+                    raise ValueError("Transaction not found")
+                if op.op == "delete":
+                    deletes.add(op.id)
+                    continue
+                changes = TransactionUpdate.model_validate(op.data or {}).model_dump(exclude_unset=True)
+                if not changes:
+                    raise ValueError("No fields to update")
+                required = [f for f in ("date", "amount", "description", "category_id", "account_id") if f in changes and changes[f] is None]
+                if required:
+                    raise ValueError(f"{', '.join(required)} cannot be null")
+                updates.setdefault(op.id, {}).update(changes)
+                update_indexes.setdefault(op.id, []).append(i)
+            else:
+                raise ValueError("op must be create, update or delete")
+        except ValidationError as e:
+            _fail(results[i], "; ".join(f"{'.'.join(map(str, err['loc']))}: {err['msg']}" for err in e.errors()))
+        except ValueError as e:
+            _fail(results[i], str(e))
+
+    # Referenced categories, accounts, users and trips must exist: one query per table
+    items = list(creates.items()) + [(i, updates[tx_id]) for tx_id, indexes in update_indexes.items() for i in indexes]
+    for i, message in _missing_references(items, session):
+        _fail(results[i], message)
+    for i in [i for i in creates if results[i]["status"] == "error"]:
+        del creates[i]
+    for tx_id, indexes in list(update_indexes.items()):
+        if any(results[i]["status"] == "error" for i in indexes):
+            # Merged changes can't be split per operation; drop them all
+            for i in indexes:
+                if results[i]["status"] == "ok":
+                    _fail(results[i], "Another update of this transaction failed")
+            del updates[tx_id], update_indexes[tx_id]
+    for tx_id in deletes:
+        updates.pop(tx_id, None) # deleted later in the batch
+
+    failed = sum(1 for r in results if r["status"] == "error")
+    if failed and all_or_nothing:
+        raise HTTPException(status_code=400, detail={"message": f"{failed} operations are invalid; nothing was applied", "results": results})
+
+    table = Transaction.__table__
+    try:
+        if creates:
+            # Entered by a person, like POST /transactions/
+            rows = [{**row, "category_manual": True} for row in creates.values()]
+            new_ids = session.connection().execute(
+                table.insert().returning(table.c.id, sort_by_parameter_order=True), rows
+            ).scalars().all()
+            for i, new_id in zip(creates, new_ids):
+                results[i]["id"] = new_id
+
+        # Rows receiving identical changes (the usual bulk action) share one UPDATE
+        groups = {}
+        for tx_id, changes in updates.items():
+            groups.setdefault(tuple(sorted(changes.items())), []).append(tx_id)
+        for changes, ids in groups.items():
+            values = dict(changes)
+            if "category_id" in values:
+                values["category_manual"] = True
+            session.connection().execute(table.update().where(table.c.id.in_(ids)).values(**values))
+
+        if deletes:
+            session.connection().execute(table.delete().where(table.c.id.in_(deletes)))
+        session.commit()
+    except Exception as e:
+        session.rollback()
+        raise HTTPException(status_code=500, detail=f"Batch failed, nothing was applied: {str(e)}")
+
+    return {
+        "created": len(creates),
+        "updated": len(updates),
+        "deleted": len(deletes),
+        "failed": failed,
+        "results": results,
+    }
+
+def _fail(result: dict, message: str):
+    result["status"] = "error"
+    result["error"] = message
+
+def _answer_int(value) -> Optional[int]:
+    # An id from an AI answer: 42 or "42"; anything unreadable matches nothing
+    try:
+        return int(value)
+    except (TypeError, ValueError):
+        return None
+
+def _missing_references(items, session: Session):
+    """Yields (operation index, message) for items whose foreign keys point at missing rows."""
+    references = {"category_id": Category, "account_id": Account, "user_id": User, "trip_id": Trip}
+    for field, model in references.items():
+        wanted = {data[field] for _, data in items if data.get(field) is not None}
+        if not wanted:
+            continue
+        found = set(session.exec(select(model.id).where(model.id.in_(wanted))).all())
+        for i, data in items:
+            if data.get(field) is not None and data[field] not in found:
+                yield i, f"{field} {data[field]} does not exist"
 
 @router.get("/ai-test")
-def test_ai_connection(session: Session = Depends(get_session)):
+def test_ai_connection(refresh: bool = False, session: Session = Depends(get_session)):
+    """Lists the Gemini models for the configured key; the list is cached unless refresh=true."""
     from models import Setting
-    import google.generativeai as genai
     
     api_key_setting = session.get(Setting, "gemini_api_key")
     if not api_key_setting or not api_key_setting.value:
         raise HTTPException(status_code=400, detail="Gemini API Key not configured.")
         
-    genai.configure(api_key=api_key_setting.value)
+    configure_ai(api_key_setting.value)
     
-    available_models = []
     try:
-        for m in genai.list_models():
-            if 'generateContent' in m.supported_generation_methods:
-                available_models.append(m.name)
+        available_models = list_generation_models(refresh=refresh)
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"Failed to list models: {str(e)}")
         
     return {
         "status": "ok",
         "available_models": available_models,
+        **model_status(),
         "message": f"Connection successful. Found {len(available_models)} models."
     }
 
 
 @router.get("/", response_model=List[TransactionRead])
 def read_transactions(
+    response: Response,
     skip: int = 0,
     limit: int = 100,
     account_id: Optional[int] = None,
@@ -59,9 +200,15 @@ def read_transactions(
     start_date: Optional[date] = None,
     end_date: Optional[date] = None,
     search: Optional[str] = None,
+    cursor: Optional[str] = None,
     session: Session = Depends(get_session)
 ):
-    query = select(Transaction)
+    """
+    Lists transactions newest first, ordered by (date, id).
+    Pass the X-Next-Cursor response header back as `cursor` to fetch the next page
+    without OFFSET. `skip` still works for older clients.
+    """
+    query = _transaction_read_query()
     
     if account_id:
         query = query.where(Transaction.account_id == account_id)
@@ -74,34 +221,45 @@ def read_transactions(
     if end_date:
         query = query.where(Transaction.date <= end_date)
     if search:
-        query = query.where(Transaction.description.contains(search))
+        query = _apply_search(query, search)
+        
+    if cursor:
+        cursor_date, cursor_id = _decode_cursor(cursor)
+        query = query.where(tuple_(Transaction.date, Transaction.id) < tuple_(cursor_date, cursor_id))
+    elif skip:
+        query = query.offset(skip)
         
-    query = query.order_by(Transaction.date.desc()).offset(skip).limit(limit)
-    transactions = session.exec(query).all()
+    query = query.order_by(Transaction.date.desc(), Transaction.id.desc()).limit(limit)
+    rows = session.exec(query).all()
     
-    return [_populate_transaction_read(t, session) for t in transactions]
+    if rows and len(rows) == limit:
+        response.headers["X-Next-Cursor"] = _encode_cursor(rows[-1].date, rows[-1].id)
+    
+    return [_row_to_transaction_read(r) for r in rows]
 
 @router.get("/{transaction_id}", response_model=TransactionRead)
 def read_transaction(transaction_id: int, session: Session = Depends(get_session)):
-    transaction = session.get(Transaction, transaction_id)
+    transaction = _read_transaction_by_id(transaction_id, session)
     if not transaction:
         raise HTTPException(status_code=404, detail="Transaction not found")
-    return _populate_transaction_read(transaction, session)
+    return transaction
 
 @router.put("/{transaction_id}", response_model=TransactionRead)
 def update_transaction(transaction_id: int, transaction: TransactionUpdate, session: Session = Depends(get_session)):
-    db_transaction = session.get(Transaction, transaction_id)
-    if not db_transaction:
-        raise HTTPException(status_code=404, detail="Transaction not found")
-        
     transaction_data = transaction.dict(exclude_unset=True)
-    for key, value in transaction_data.items():
-        setattr(db_transaction, key, value)
+    if "category_id" in transaction_data:
+        transaction_data["category_manual"] = True
         
-    session.add(db_transaction)
-    session.commit()
-    session.refresh(db_transaction)
-    return _populate_transaction_read(db_transaction, session)
+    # One UPDATE, then the same single read as GET; no ORM load first
+    if transaction_data:
+        table = Transaction.__table__
+        result = session.connection().execute(table.update().where(table.c.id == transaction_id).values(**transaction_data))
+        if result.rowcount:
+            session.commit()
+    updated = _read_transaction_by_id(transaction_id, session)
+    if not updated:
+        raise HTTPException(status_code=404, detail="Transaction not found")
+    return updated
 
 @router.delete("/{transaction_id}")
 def delete_transaction(transaction_id: int, session: Session = Depends(get_session)):
@@ -112,32 +270,78 @@ def delete_transaction(transaction_id: int, session: Session = Depends(get_sessi
     session.commit()
     return {"ok": True}
 
-def _populate_transaction_read(transaction: Transaction, session: Session) -> TransactionRead:
-    # Manual population because SQLModel/Pydantic validation with relationships can be tricky
-    # and we want flat strings for the UI table.
-    # Note: Accessing transaction.category triggers lazy load if attached to session.
-    
-    category_name = transaction.category.name if transaction.category else None
-    account_name = transaction.account.name if transaction.account else None
-    user_name = transaction.user.name if transaction.user else None
-    trip_name = transaction.trip.name if transaction.trip else None
-    
+def _transaction_read_query():
+    # One LEFT JOIN projection of the flat columns the UI table needs.
+    # Touching transaction.category/.account/.user/.trip instead would issue
+    # a lazy SELECT per relationship per row (N+1).
+    return (
+        select(
+            Transaction.id,
+            Transaction.date,
+            Transaction.amount,
+            Transaction.description,
+            Transaction.category_id,
+            Transaction.account_id,
+            Transaction.user_id,
+            Transaction.trip_id,
+            Transaction.is_family,
+            Category.name.label("category_name"),
+            Account.name.label("account_name"),
+            User.name.label("user_name"),
+            Trip.name.label("trip_name"),
+        )
+        .select_from(Transaction)
+        .join(Category, Transaction.category_id == Category.id, isouter=True)
+        .join(Account, Transaction.account_id == Account.id, isouter=True)
+        .join(User, Transaction.user_id == User.id, isouter=True)
+        .join(Trip, Transaction.trip_id == Trip.id, isouter=True)
+    )
+
+def _fts_match_expression(search: str) -> Optional[str]:
+    # A quoted trigram phrase matches the same rows as LIKE '%search%', without a scan.
+    # Shorter terms have no trigram to look up and stay on LIKE.
+    if len(search) < 3:
+        return None
+    return '"' + search.replace('"', '""') + '"'
+
+def _apply_search(query, search: str):
+    match = _fts_match_expression(search) if database.FTS_ENABLED else None
+    if not match:
+        return query.where(Transaction.description.contains(search))
+    fts_ids = text("SELECT rowid FROM transaction_fts WHERE transaction_fts MATCH :match").bindparams(match=match)
+    return query.where(Transaction.id.in_(fts_ids))
+
+def _encode_cursor(tx_date: date, tx_id: int) -> str:
+    return base64.urlsafe_b64encode(f"{tx_date.isoformat()}|{tx_id}".encode()).decode()
+
+def _decode_cursor(cursor: str):
+    try:
+        raw_date, raw_id = base64.urlsafe_b64decode(cursor.encode()).decode().split("|")
+        return date.fromisoformat(raw_date), int(raw_id)
+    except Exception:
+        raise HTTPException(status_code=400, detail="Invalid cursor")
+
+def _row_to_transaction_read(row) -> TransactionRead:
     return TransactionRead(
-        id=transaction.id,
-        date=transaction.date,
-        amount=transaction.amount,
-        description=transaction.description,
-        category_id=transaction.category_id,
-        account_id=transaction.account_id,
-        user_id=transaction.user_id,
-        trip_id=transaction.trip_id,
-        category_name=category_name,
-        account_name=account_name,
-        user_name=user_name,
-        trip_name=trip_name,
-        is_family=transaction.is_family
+        id=row.id,
+        date=row.date,
+        amount=row.amount,
+        description=row.description,
+        category_id=row.category_id,
+        account_id=row.account_id,
+        user_id=row.user_id,
+        trip_id=row.trip_id,
+        category_name=row.category_name,
+        account_name=row.account_name,
+        user_name=row.user_name,
+        trip_name=row.trip_name,
+        is_family=row.is_family
     )
 
+def _read_transaction_by_id(transaction_id: int, session: Session) -> Optional[TransactionRead]:
+    row = session.exec(_transaction_read_query().where(Transaction.id == transaction_id)).first()
+    return _row_to_transaction_read(row) if row else None
+
 class AICategorizeRequest(SQLModel):
     transaction_ids: List[int]
 
@@ -145,118 +349,115 @@ class AICategorizeRequest(SQLModel):
 def ai_categorize_transactions(request: AICategorizeRequest, session: Session = Depends(get_session)):
     # 1. Get API Key
     from models import Setting, ImportRule
-    import google.generativeai as genai
-    import json
     
     api_key_setting = session.get(Setting, "gemini_api_key")
     if not api_key_setting or not api_key_setting.value:
         raise HTTPException(status_code=400, detail="Gemini API Key not configured in Settings.")
         
-    genai.configure(api_key=api_key_setting.value)
+    configure_ai(api_key_setting.value)
     
     # 2. Get Data
     categories = session.exec(select(Category)).all()
     categories_str = "\n".join([f"{c.id}: {c.name}" for c in categories])
     
-    transactions = []
-    for tid in request.transaction_ids:
-        t = session.get(Transaction, tid)
-        if t: transactions.append(t)
+    # Only the columns the prompt needs, in one query
+    transactions = session.exec(
+        select(Transaction.id, Transaction.description, Transaction.amount)
+        .where(Transaction.id.in_(set(request.transaction_ids)))
+        .order_by(Transaction.id)
+    ).all() if request.transaction_ids else []
         
     if not transactions:
         return {"processed": 0, "message": "No transactions found."}
         
-    transactions_str = "\n".join([f"{t.id}: {t.description} (${t.amount})" for t in transactions])
-    
-    # 3. Construct Prompt
-    prompt = f"""
-You are a helpful personal finance assistant.
-Your task is to categorize the following transactions based on the provided categories.
-You should also suggest a 'rule_pattern' to auto-categorize similar transactions in the future (e.g. for 'Starbucks #123' use 'Starbucks').
-
-Categories:
-{categories_str}
+    # 3. Cached answers for known merchants, the model for the rest
+    valid_category_ids = {c.id for c in categories}
+    merchant_keys = {t.id: merchant_key(t.description) for t in transactions}
+    cached = lookup_cache(session, merchant_keys.values())
+    results = []
+    misses = []
+    for t in transactions:
+        entry = cached.get(merchant_keys[t.id])
+        if entry:
+            # No rule_pattern: rules come from fresh answers only, so a rule the user deleted stays deleted
+            results.append({"id": t.id, "category_id": entry.category_id, "rule_pattern": None})
+        else:
+            misses.append(t)
 
-Transactions:
-{transactions_str}
+    # Each merchant is asked once, under the id of its first transaction
+    groups = {}
+    for t in misses:
+        groups.setdefault(merchant_keys[t.id] or t.id, []).append(t)
+    representatives = {group[0].id: group for group in groups.values()}
 
-Return a generic JSON list of objects. Each object must have:
-- "id": (int) the transaction id
-- "category_id": (int) the matched category id, or null if absolutely unsure.
-- "rule_pattern": (string) a keyword/substring to match this merchant, or null if generic.
+    # Token-budgeted chunks, sent concurrently (see ai_categorizer.py)
+    chunk_reports = []
+    if misses:
+        transaction_lines = [f"{group[0].id}: {group[0].description} (${group[0].amount})" for group in groups.values()]
+        ai_results, chunk_reports = categorize(transaction_lines, categories_str)
+        if not results and all(r["status"] == "failed" for r in chunk_reports):
+            raise HTTPException(status_code=500, detail=f"AI Processing Failed. Last error: {chunk_reports[-1]['error']}")
 
-Respond ONLY with the JSON list.
-"""
-
-    # 4. Call Model
-    models_to_try = ['gemini-2.0-flash', 'gemini-2.0-flash-exp', 'gemini-1.5-flash', 'gemini-1.5-flash-001', 'gemini-pro']
-    model = None
-    response = None
-    last_error = None
-
-    for model_name in models_to_try:
-        try:
-            print(f"Attempting AI categorization with model: {model_name}")
-            model = genai.GenerativeModel(model_name)
-            response = model.generate_content(prompt)
-            print(f"Success with model: {model_name}")
-            break
-        except Exception as e:
-            print(f"Failed with {model_name}: {e}")
-            last_error = e
-    
-    if not response:
-         raise HTTPException(status_code=500, detail=f"AI Processing Failed. Tried models {models_to_try}. Last error: {str(last_error)}")
-
-    try:
-        text_response = response.text
-        
-        # Cleanup markdown
-        if "```json" in text_response:
-             text_response = text_response.split("```json")[1].split("```")[0]
-        elif "```" in text_response:
-             text_response = text_response.split("```")[1].split("```")[0]
-             
-        results = json.loads(text_response)
+        # Only answers about requested merchants with an existing category are used and remembered.
+        # The model sometimes quotes numbers ("42"), so ids are compared as ints.
+        ai_results = [
+            {**r, "id": _answer_int(r.get("id")), "category_id": _answer_int(r.get("category_id"))}
+            for r in ai_results if isinstance(r, dict)
+        ]
+        ai_results = [r for r in ai_results if r["id"] in representatives and r["category_id"] in valid_category_ids]
+        for res in ai_results:
+            results.extend({**res, "id": t.id} for t in representatives[res["id"]])
+        store_cache(session, {
+            merchant_keys[r["id"]]: {
+                "category_id": r["category_id"],
+                "rule_pattern": r.get("rule_pattern"),
+                "confidence": r.get("confidence"),
+            }
+            for r in ai_results
+        })
+    failed_chunks = [r for r in chunk_reports if r["status"] == "failed"]
         
-    except Exception as e:
-        print(f"AI Response Parsing Error: {e}")
-        raise HTTPException(status_code=500, detail=f"AI Response Parsing Failed: {str(e)}")
-        
-    # 5. Process Results
-    updated_count = 0
-    rules_created = 0
-    
+    # 4. Process Results: one UPDATE per category and one INSERT for the new rules
+    ids_by_category = {}
+    new_rules = {}
+    existing_patterns = set(session.exec(select(ImportRule.pattern)).all())
     for res in results:
         tid = res.get("id")
         cid = res.get("category_id")
         pattern = res.get("rule_pattern")
-        
-        if not tid: continue
-        
-        # Update Transaction
-        if cid:
-            t = session.get(Transaction, tid)
-            if t:
-                t.category_id = cid
-                session.add(t)
-                updated_count += 1
-                
-        # Create Rule (if pattern provided and cid provided)
-        if pattern and cid:
-            # Check duplicate rule
-            existing = session.exec(select(ImportRule).where(ImportRule.pattern == pattern)).first()
-            if not existing:
-                new_rule = ImportRule(pattern=pattern, category_id=cid)
-                session.add(new_rule)
-                rules_created += 1
-                
+        if not tid or not cid: continue
+        ids_by_category.setdefault(cid, []).append(tid)
+        # Create Rule unless the pattern already exists
+        if pattern and pattern not in existing_patterns and pattern not in new_rules:
+            new_rules[pattern] = cid
+
+    table = Transaction.__table__
+    for cid, ids in ids_by_category.items():
+        session.connection().execute(table.update().where(table.c.id.in_(ids)).values(category_id=cid))
+    if new_rules:
+        session.connection().execute(
+            ImportRule.__table__.insert(),
+            [{"pattern": pattern, "category_id": cid} for pattern, cid in new_rules.items()],
+        )
+    updated_count = sum(len(ids) for ids in ids_by_category.values())
+    rules_created = len(new_rules)
     session.commit()
+    if rules_created:
+        invalidate_rule_matcher()
     
+    message = f"AI categorized {updated_count} transactions ({len(transactions) - len(misses)} from cache) and created {rules_created} new rules."
+    if failed_chunks:
+        # Chunk reports count merchants; every transaction of those merchants is left out
+        answered = {res["id"] for res in results}
+        skipped = sum(1 for t in misses if t.id not in answered)
+        message += f" {len(failed_chunks)} of {len(chunk_reports)} batches failed; {skipped} transactions were left unchanged."
     return {
         "processed": len(transactions),
         "updated": updated_count,
         "new_rules": rules_created,
-        "message": f"AI categorized {updated_count} transactions and created {rules_created} new rules."
+        "chunks": chunk_reports,
+        "cache": {"hits": len(transactions) - len(misses), "misses": len(misses)},
+        "merchants_sent": len(groups),
+        "message": message
     }
 
@@ -1,9 +1,9 @@
 from typing import List, Optional
 from fastapi import APIRouter, Depends, HTTPException, Query
-from sqlmodel import Session, select
+from sqlmodel import Session, select, update
 
 from database import get_session
-from models import Trip, TripCreate, TripRead, TripUpdate
+from models import Trip, TripCreate, TripRead, TripUpdate, Transaction
 
 router = APIRouter(prefix="/trips", tags=["trips"])
 
@@ -40,6 +40,8 @@ def delete_trip(trip_id: int, session: Session = Depends(get_session)):
     trip = session.get(Trip, trip_id)
     if not trip:
         raise HTTPException(status_code=404, detail="Trip not found")
+    # Transactions stay but lose the trip tag
+    session.exec(update(Transaction).where(Transaction.trip_id == trip_id).values(trip_id=None))
     session.delete(trip)
     session.commit()
     return {"ok": True}
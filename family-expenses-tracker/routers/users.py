@@ -1,4 +1,5 @@
 from fastapi import APIRouter, Depends, HTTPException
+from sqlalchemy.exc import IntegrityError
 from sqlmodel import Session, select
 from typing import List
 
@@ -26,7 +27,11 @@ def delete_user(user_id: int, session: Session = Depends(get_session)):
     if not user:
         raise HTTPException(status_code=404, detail="User not found")
     session.delete(user)
-    session.commit()
+    try:
+        session.commit()
+    except IntegrityError:
+        session.rollback()
+        raise HTTPException(status_code=409, detail="User still owns accounts or transactions. Reassign or delete them first.")
     return {"ok": True}
 
 @router.put("/{user_id}", response_model=UserRead)
@@ -0,0 +1,164 @@
+"""
+Compiled import-rule matcher.
+
+All rule patterns are compiled into one Aho-Corasick automaton, so matching a
+description costs O(len(description)) no matter how many rules exist.
+When several patterns occur in a description, the rule with the lowest id
+(the oldest rule) wins, which is the order rules have always been tried in.
+
+The compiled matcher is cached per process and must be invalidated whenever
+rules are created, updated or deleted (see invalidate_rule_matcher).
+"""
+import threading
+from collections import deque
+from typing import Iterable, List, Optional, Tuple
+
+from sqlalchemy import bindparam
+from sqlmodel import Session, select, func
+
+from models import ImportRule, Transaction
+
+# Transactions read, matched and committed per step of a ledger-wide re-application
+REAPPLY_CHUNK_SIZE = 2000
+
+class RuleMatcher:
+    def __init__(self, rules: Iterable[Tuple[int, str, int]]):
+        """rules: (rule_id, pattern, category_id) tuples."""
+        # Node 0 is the root. goto[n] maps a character to the next node,
+        # best[n] is the winning (rule_id, category_id) of every pattern that
+        # ends at n or at any suffix of n (via failure links).
+        self.goto: List[dict] = [{}]
+        self.fail: List[int] = [0]
+        self.best: List[Optional[Tuple[int, int]]] = [None]
+        self.rule_count = 0
+
+        for rule_id, pattern, category_id in rules:
+            pattern = (pattern or "").lower()
+            if not pattern.strip():
+                continue # an empty pattern would match everything
+            self.rule_count += 1
+            node = 0
+            for ch in pattern:
+                nxt = self.goto[node].get(ch)
+                if nxt is None:
+                    nxt = len(self.goto)
+                    self.goto[node][ch] = nxt
+                    self.goto.append({})
+                    self.fail.append(0)
+                    self.best.append(None)
+                node = nxt
+            self.best[node] = _earliest(self.best[node], (rule_id, category_id))
+
+        self._build_failure_links()
+
+    def _build_failure_links(self):
+        # Breadth-first, so a node's failure target is always finished before the node itself
+        queue = deque(self.goto[0].values())
+        while queue:
+            node = queue.popleft()
+            for ch, child in self.goto[node].items():
+                queue.append(child)
+                state = self.fail[node]
+                while state and ch not in self.goto[state]:
+                    state = self.fail[state]
+                target = self.goto[state].get(ch, 0)
+                self.fail[child] = target if target != child else 0
+                self.best[child] = _earliest(self.best[child], self.best[self.fail[child]])
+
+    def match_rule(self, description: str) -> Optional[Tuple[int, int]]:
+        """Returns (rule_id, category_id) of the winning rule, or None."""
+        goto, fail, best = self.goto, self.fail, self.best
+        node = 0
+        found = None
+        for ch in description.lower():
+            while node and ch not in goto[node]:
+                node = fail[node]
+            node = goto[node].get(ch, 0)
+            if best[node] is not None:
+                found = _earliest(found, best[node])
+        return found
+
+    def match(self, description: str) -> Optional[int]:
+        """Returns the matching category_id or None."""
+        found = self.match_rule(description)
+        return found[1] if found else None
+
+def _earliest(a, b):
+    if a is None:
+        return b
+    if b is None:
+        return a
+    return a if a[0] <= b[0] else b
+
+# --- Process-wide cache ---
+
+_lock = threading.Lock()
+_cached_matcher: Optional[RuleMatcher] = None
+_generation = 0
+
+def get_rule_matcher(session: Session) -> RuleMatcher:
+    global _cached_matcher
+    with _lock:
+        if _cached_matcher is not None:
+            return _cached_matcher
+        generation = _generation
+    rows = session.exec(select(ImportRule.id, ImportRule.pattern, ImportRule.category_id)).all()
+    matcher = RuleMatcher(rows)
+    with _lock:
+        # Only cache if no rule changed while we were building
+        if generation == _generation:
+            _cached_matcher = matcher
+    return matcher
+
+def invalidate_rule_matcher():
+    global _cached_matcher, _generation
+    with _lock:
+        _cached_matcher = None
+        _generation += 1
+
+# --- Ledger-wide re-application ---
+
+def reapply_rules_to_ledger(job, engine, chunk_size: int = REAPPLY_CHUNK_SIZE) -> dict:
+    """
+    Runs the full rule set over every transaction whose category was not set
+    manually, walking the ledger in id order and committing per chunk so the
+    write lock is released between chunks. Rows no rule matches are left alone.
+    job: a jobs.Job whose total/processed are updated as chunks complete.
+    """
+    table = Transaction.__table__
+    set_category = table.update()\
+        .where(table.c.id == bindparam("tx_id"))\
+        .values(category_id=bindparam("new_category_id"))
+
+    with Session(engine) as session:
+        matcher = get_rule_matcher(session)
+        job.total = session.exec(
+            select(func.count(Transaction.id)).where(Transaction.category_manual == False)
+        ).one()
+
+        last_id = 0
+        updated = 0
+        while True:
+            rows = session.exec(
+                select(Transaction.id, Transaction.description, Transaction.category_id)
+                .where(Transaction.id > last_id)
+                .where(Transaction.category_manual == False)
+                .order_by(Transaction.id)
+                .limit(chunk_size)
+            ).all()
+            if not rows:
+                break
+            changes = []
+            for tx_id, description, category_id in rows:
+                new_category_id = matcher.match(description or "")
+                if new_category_id and new_category_id != category_id:
+                    changes.append({"tx_id": tx_id, "new_category_id": new_category_id})
+            if changes:
+                session.connection().execute(set_category, changes)
+            session.commit()
+
+            updated += len(changes)
+            last_id = rows[-1][0]
+            job.processed += len(rows)
+
+    return {"updated": updated, "rules": matcher.rule_count}
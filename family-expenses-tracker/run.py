@@ -1,9 +1,13 @@
-from fastapi import FastAPI
+import time
+_PROCESS_START = time.monotonic()
+
+from fastapi import FastAPI, Request
 import uvicorn
 from contextlib import asynccontextmanager
 
 from database import create_db_and_tables
-from routers import users, accounts, categories, transactions, imports, trips, settings, stats
+from importer import clear_import_spool
+from routers import users, accounts, categories, transactions, imports, trips, settings, stats, diagnostics
 
 @asynccontextmanager
 async def lifespan(app: FastAPI):
@@ -12,19 +16,14 @@ async def lifespan(app: FastAPI):
     print("   FAMILY EXPENSES TRACKER - VERSION v0.9.17")
     print("--------------------------------------------------")
     
-    # Run Database Creation
+    # Run Database Creation / Migrations
+    db_start = time.monotonic()
     create_db_and_tables()
-
-    # Diagnostic: Check Tables
-    from database import engine
-    from sqlmodel import Session, text
-    print("[DIAGNOSTIC] Checking tables after startup...")
-    with Session(engine) as session:
-        try:
-            result = session.exec(text("SELECT name FROM sqlite_master WHERE type='table'")).all()
-            print(f"[DIAGNOSTIC] Existing Tables: {result}")
-        except Exception as e:
-            print(f"[DIAGNOSTIC] Failed to list tables: {e}")
+    clear_import_spool()
+    diagnostics.STARTUP_TIMINGS["database_ms"] = round((time.monotonic() - db_start) * 1000, 1)
+    diagnostics.STARTUP_TIMINGS["startup_ms"] = round((time.monotonic() - _PROCESS_START) * 1000, 1)
+    print(f"[DIAGNOSTIC] Startup completed in {diagnostics.STARTUP_TIMINGS['startup_ms']} ms "
+          f"(database {diagnostics.STARTUP_TIMINGS['database_ms']} ms)")
     print("--------------------------------------------------")
     yield
     # Shutdown
@@ -49,6 +48,15 @@ app.include_router(imports.router)
 app.include_router(trips.router)
 app.include_router(settings.router)
 app.include_router(stats.router)
+app.include_router(diagnostics.router)
+
+@app.middleware("http")
+async def record_first_request(request: Request, call_next):
+    response = await call_next(request)
+    if "first_request_ms" not in diagnostics.STARTUP_TIMINGS:
+        diagnostics.STARTUP_TIMINGS["first_request_ms"] = round((time.monotonic() - _PROCESS_START) * 1000, 1)
+        print(f"[DIAGNOSTIC] Time to first request: {diagnostics.STARTUP_TIMINGS['first_request_ms']} ms")
+    return response
 
 @app.get("/")
 def read_root():
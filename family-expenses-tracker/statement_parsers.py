@@ -0,0 +1,169 @@
+"""
+Streaming parsers for OFX/QFX and ISO 20022 CAMT.053 statements.
+
+Both yield (date, amount, description) records one transaction at a time,
+for the same rule matching and insert pipeline as CSV (see importer.py).
+Neither keeps more than one transaction in memory:
+- OFX 1.x is SGML (leaf tags are never closed), so it is read in chunks by
+  a small tokenizer instead of an XML parser; OFX 2.x XML tokenizes the same way.
+- CAMT.053 is read with iterparse, and every <Ntry> is removed from the tree
+  once processed.
+"""
+import codecs
+import html
+import re
+import xml.etree.ElementTree as ET
+from datetime import date
+from typing import IO, Iterator, Optional, Tuple
+
+Record = Tuple[date, float, str]
+
+# Bytes looked at to tell the statement type, and read per parsing step
+SNIFF_BYTES = 4096
+CHUNK_BYTES = 64 * 1024
+
+class StatementParseError(ValueError):
+    """The file looks like an OFX or CAMT statement but cannot be read."""
+
+def sniff_statement_type(head: bytes) -> str:
+    """Returns "ofx", "camt" or "csv" from the first bytes of a file."""
+    text = head.lstrip(b"\xef\xbb\xbf \t\r\n").upper()
+    if text.startswith(b"OFXHEADER") or b"<OFX>" in text:
+        return "ofx"
+    if text.startswith(b"<?XML") or text.startswith(b"<DOCUMENT"):
+        if b"CAMT.053" in text or b"BKTOCSTMRSTMT" in text:
+            return "camt"
+        if b"<OFX" in text or b"OFXHEADER" in text:
+            return "ofx"
+    return "csv"
+
+# --- OFX / QFX ---
+
+_OFX_TAG = re.compile(r"<(/?)([A-Za-z0-9.]+)[^>]*>([^<]*)")
+
+def iter_ofx_records(binary_file: IO[bytes]) -> Iterator[Record]:
+    current = None # fields of the <STMTTRN> being read
+    for closing, tag, value in _ofx_tokens(binary_file):
+        if tag == "STMTTRN":
+            if not closing:
+                current = {}
+            elif current is not None:
+                yield _ofx_record(current)
+                current = None
+        elif current is not None and not closing and value:
+            current[tag] = value
+
+def _ofx_record(fields: dict) -> Record:
+    try:
+        posted = fields.get("DTPOSTED") or fields.get("DTUSER") or ""
+        tx_date = date(int(posted[0:4]), int(posted[4:6]), int(posted[6:8])) # YYYYMMDD[HHMMSS...]
+        amount = float(fields["TRNAMT"].replace(",", "."))
+    except (KeyError, ValueError) as e:
+        raise StatementParseError(f"Unreadable OFX transaction {fields.get('FITID', '')}: {e}")
+    description = fields.get("NAME") or fields.get("PAYEE") or fields.get("MEMO") or "Imported Transaction"
+    memo = fields.get("MEMO")
+    if memo and memo not in description:
+        description = f"{description} {memo}"
+    return tx_date, amount, description
+
+def _ofx_tokens(binary_file: IO[bytes]) -> Iterator[Tuple[bool, str, str]]:
+    """Yields (is_closing, TAG, text after the tag) while reading the file in chunks."""
+    head = binary_file.read(CHUNK_BYTES)
+    decoder = codecs.getincrementaldecoder(_ofx_encoding(head))(errors="replace")
+    buffer = decoder.decode(head)
+    while True:
+        chunk = binary_file.read(CHUNK_BYTES)
+        buffer += decoder.decode(chunk, final=not chunk)
+        # A tag's text runs to the next '<', so everything before the last '<' is complete
+        end = len(buffer) if not chunk else max(buffer.rfind("<"), 0)
+        for m in _OFX_TAG.finditer(buffer, 0, end):
+            yield m.group(1) == "/", m.group(2).upper(), html.unescape(m.group(3).strip())
+        buffer = buffer[end:]
+        if not chunk:
+            return
+
+def _ofx_encoding(head: bytes) -> str:
+    header = head[:SNIFF_BYTES].upper()
+    if b"ENCODING:UTF-8" in header or b'ENCODING="UTF-8"' in header or header.startswith(b"\xef\xbb\xbf"):
+        return "utf-8-sig"
+    if b"<?XML" in header and b"ENCODING=" not in header:
+        return "utf-8"
+    return "cp1252" # OFX 1.x CHARSET:1252 / USASCII
+
+# --- CAMT.053 ---
+
+def iter_camt_records(binary_file: IO[bytes]) -> Iterator[Record]:
+    ntry_tag = stmt_tag = None
+    statement = None # the <Stmt> entries are removed from
+    try:
+        for event, elem in ET.iterparse(binary_file, events=("start", "end")):
+            if ntry_tag is None:
+                # Tags are compared with the document's namespace rather than stripped per event
+                namespace = elem.tag[:elem.tag.index("}") + 1] if elem.tag.startswith("{") else ""
+                ntry_tag, stmt_tag = namespace + "Ntry", namespace + "Stmt"
+            if event == "start":
+                if elem.tag == stmt_tag:
+                    statement = elem
+                continue
+            if elem.tag != ntry_tag:
+                continue
+            record = _camt_record(elem)
+            # Drop the processed entry so memory stays flat over the whole statement
+            elem.clear()
+            if statement is not None:
+                statement.remove(elem)
+            if record:
+                yield record
+    except ET.ParseError as e:
+        raise StatementParseError(f"Invalid CAMT.053 XML: {e}")
+
+def _camt_record(entry) -> Optional[Record]:
+    fields = _camt_fields(entry)
+    if (fields.get("Sts") or fields.get("Sts/Cd") or "BOOK") not in ("BOOK", "BOOKED"):
+        return None # pending and informational entries are not on the statement yet
+    raw_amount = fields.get("Amt")
+    raw_date = fields.get("BookgDt/Dt") or fields.get("BookgDt/DtTm") or fields.get("ValDt/Dt")
+    try:
+        amount = float(raw_amount)
+        tx_date = date.fromisoformat(raw_date[:10])
+    except (TypeError, ValueError):
+        raise StatementParseError(f"Unreadable CAMT entry: amount {raw_amount!r}, date {raw_date!r}")
+
+    debit = fields.get("CdtDbtInd") == "DBIT"
+    if fields.get("RvslInd") == "true":
+        debit = not debit
+    if debit:
+        amount = -amount
+
+    # Who the money went to (debits) or came from (credits), then the remittance text
+    party = "NtryDtls/TxDtls/RltdPties/" + ("Cdtr" if debit else "Dbtr")
+    name = fields.get(f"{party}/Nm") or fields.get(f"{party}/Pty/Nm")
+    remittance = fields.get("NtryDtls/TxDtls/RmtInf/Ustrd")
+    parts = [p for p in (name, remittance) if p]
+    description = " ".join(parts) or fields.get("AddtlNtryInf") or "Imported Transaction"
+    return tx_date, amount, description
+
+_local_names = {}
+
+def _local(tag: str) -> str:
+    name = _local_names.get(tag)
+    if name is None:
+        name = _local_names[tag] = tag.rsplit("}", 1)[-1]
+    return name
+
+def _camt_fields(entry, prefix: str = "", fields: Optional[dict] = None) -> dict:
+    """
+    Flattens an entry into {"BookgDt/Dt": text, ...} in one walk, keeping the
+    first value per path. Namespaces are dropped: CAMT.053 versions differ only in them.
+    """
+    if fields is None:
+        fields = {}
+    for child in entry:
+        path = prefix + _local(child.tag)
+        if path not in fields:
+            text = child.text.strip() if child.text else ""
+            if text:
+                fields[path] = text
+        if len(child):
+            _camt_fields(child, path + "/", fields)
+    return fields
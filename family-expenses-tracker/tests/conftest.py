@@ -0,0 +1,66 @@
+import os
+import sys
+
+import pytest
+from fastapi.testclient import TestClient
+from sqlalchemy import event
+from sqlmodel import create_engine
+
+APP_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, APP_DIR)
+
+import database
+from bank_formats import invalidate_format_registry
+from rule_matcher import invalidate_rule_matcher
+
+@pytest.fixture
+def engine(tmp_path, monkeypatch):
+    """A migrated and seeded database in a temp file, used by every session."""
+    test_engine = create_engine(f"sqlite:///{tmp_path / 'expenses.db'}", connect_args={"check_same_thread": False})
+    event.listen(test_engine, "connect", database._apply_sqlite_pragmas)
+    monkeypatch.setattr(database, "engine", test_engine)
+    database.create_db_and_tables()
+    # Process-wide caches must not carry rows over from another test's database
+    invalidate_rule_matcher()
+    invalidate_format_registry()
+    yield test_engine
+    test_engine.dispose()
+
+@pytest.fixture
+def client(engine, monkeypatch):
+    # run.py mounts static/ relative to the working directory
+    monkeypatch.chdir(APP_DIR)
+    import run
+    # Not entered as a context manager: the lifespan would migrate the default database
+    return TestClient(run.app)
+
+@pytest.fixture
+def statements(engine):
+    """Every SQL statement sent to the test database, in order."""
+    executed = []
+
+    def record(conn, cursor, statement, parameters, context, executemany):
+        executed.append((statement, parameters))
+
+    event.listen(engine, "before_cursor_execute", record)
+    yield executed
+    event.remove(engine, "before_cursor_execute", record)
+
+@pytest.fixture
+def seed(client):
+    """seed(rows) adds a user, account, trip and that many fully linked transactions."""
+    def add(rows: int) -> dict:
+        user = client.post("/users/", json={"name": "Alex"}).json()
+        account = client.post("/accounts/", json={"name": "Checking", "user_id": user["id"]}).json()
+        trip = client.post("/trips/", json={"name": "Lisbon"}).json()
+        category_id = client.get("/categories/").json()[0]["id"]
+        ids = []
+        for i in range(rows):
+            created = client.post("/transactions/", json={
+                "date": f"2025-03-{i % 28 + 1:02d}", "amount": -10.0 - i, "description": f"Shop {i}",
+                "category_id": category_id, "account_id": account["id"], "user_id": user["id"], "trip_id": trip["id"],
+            })
+            assert created.status_code == 200, created.text
+            ids.append(created.json()["id"])
+        return {"user": user, "account": account, "trip": trip, "category_id": category_id, "ids": ids}
+    return add
@@ -0,0 +1,45 @@
+import pytest
+
+import routers.transactions as transactions_router
+
+@pytest.fixture
+def answering(client, monkeypatch):
+    """answering(answers) makes the model reply answers(prompt lines) instead of calling Gemini."""
+    client.put("/settings/gemini_api_key", json={"key": "gemini_api_key", "value": "test-key"})
+    monkeypatch.setattr(transactions_router, "configure_ai", lambda api_key: None)
+
+    def answer(answers):
+        def categorize(transaction_lines, categories_str):
+            return answers(transaction_lines), [{"chunk": 0, "transactions": len(transaction_lines), "status": "ok", "error": None}]
+        monkeypatch.setattr(transactions_router, "categorize", categorize)
+    return answer
+
+def _line_id(line):
+    return int(line.split(":")[0])
+
+@pytest.mark.parametrize("quote", [str, int])
+def test_answers_with_quoted_ids_are_applied(client, seed, answering, quote):
+    seeded = seed(2)
+    target = client.post("/categories/", json={"name": "Groceries", "icon": "g"}).json()["id"]
+    answering(lambda lines: [
+        {"id": quote(_line_id(line)), "category_id": quote(target), "rule_pattern": None, "confidence": "0.9"} for line in lines
+    ])
+
+    response = client.post("/transactions/ai-categorize", json={"transaction_ids": seeded["ids"]})
+    assert response.status_code == 200, response.text
+    assert response.json()["updated"] == 2
+    assert {client.get(f"/transactions/{i}").json()["category_id"] for i in seeded["ids"]} == {target}
+
+def test_unreadable_or_unknown_answer_ids_are_ignored(client, seed, answering):
+    seeded = seed(1)
+    answering(lambda lines: [
+        {"id": "abc", "category_id": seeded["category_id"]},
+        {"id": None, "category_id": seeded["category_id"]},
+        {"id": "999999", "category_id": seeded["category_id"]},
+        {"id": str(_line_id(lines[0])), "category_id": "not a category"},
+        "not an object",
+    ])
+
+    response = client.post("/transactions/ai-categorize", json={"transaction_ids": seeded["ids"]})
+    assert response.status_code == 200, response.text
+    assert response.json()["updated"] == 0
@@ -0,0 +1,83 @@
+import os
+
+import pytest
+
+from bank_formats import (BUILTIN_FORMATS, BankFormatRegistry, format_from_mapping, guess_header_format,
+                          mapping_header)
+from importer import iter_csv_rows
+from models import BankFormatMapping
+
+SAMPLES = os.path.join(os.path.dirname(os.path.abspath(__file__)), "samples")
+
+def _rows(name):
+    with open(os.path.join(SAMPLES, name), "rb") as sample:
+        return list(iter_csv_rows(sample))
+
+SEMICOLON = BankFormatMapping(name="Caixa", header="Data;Descrição;Montante (EUR);Saldo", date_column="Data",
+                              description_column="Descrição", amount_column="Montante (EUR)", date_format="%d/%m/%Y",
+                              decimal_separator=",")
+QUOTED = BankFormatMapping(name="Quoted", header='"Booking date","Text, as printed","Amount (EUR)"',
+                           date_column="Booking date", description_column="Text, as printed", amount_column="Amount (EUR)")
+
+@pytest.mark.parametrize("name, cells", [
+    ("generic.csv", 4), ("semicolon.csv", 4), ("quoted_header.csv", 3), ("mastercard.csv", 12),
+])
+def test_rows_are_split_on_the_file_delimiter(name, cells):
+    rows = _rows(name)
+    assert {len(row) for row in rows} == {cells}
+
+def test_quoted_delimiters_stay_in_their_cell():
+    assert _rows("semicolon.csv")[1][1] == "Pingo Doce, Lisboa"
+    assert _rows("quoted_header.csv")[0][1] == "Text, as printed"
+
+def test_mapping_header_reads_semicolons_and_quotes():
+    assert mapping_header(SEMICOLON) == ("data", "descrição", "montante (eur)", "saldo")
+    assert mapping_header(QUOTED) == ("booking date", "text, as printed", "amount (eur)")
+    assert mapping_header(BankFormatMapping(name="Plain", header="Date, Description ,Amount\n", date_column="Date",
+                                            amount_column="Amount")) == ("date", "description", "amount")
+
+def test_guess_header_format_finds_named_columns():
+    fmt = guess_header_format(_rows("generic.csv")[0])
+    assert (fmt.name, fmt.date_idx, fmt.desc_idx, fmt.amount_idx) == ("Generic", 0, 1, 2)
+    assert guess_header_format(["Posted Date", "Payee", "Amount"]).desc_idx == 1
+    assert guess_header_format(["Date", "Memo", "Debit"]) is None
+
+def test_registry_detects_the_headerless_builtin_format():
+    registry = BankFormatRegistry(BUILTIN_FORMATS)
+    first_row = _rows("mastercard.csv")[0]
+    assert registry.detect(first_row).name == "Mastercard"
+    # Too few columns for the layout: not Mastercard, and no header to guess from
+    assert registry.detect(first_row[:6]) is None
+
+@pytest.mark.parametrize("mapping, sample, indices", [
+    (SEMICOLON, "semicolon.csv", (0, 1, 2)),
+    (QUOTED, "quoted_header.csv", (0, 1, 2)),
+])
+def test_registry_detects_custom_mappings_from_sample_files(mapping, sample, indices):
+    registry = BankFormatRegistry([format_from_mapping(mapping)] + BUILTIN_FORMATS)
+    fmt = registry.detect(_rows(sample)[0])
+    assert fmt.name == mapping.name
+    assert (fmt.date_idx, fmt.desc_idx, fmt.amount_idx) == indices
+    assert fmt.decimal_separator == mapping.decimal_separator
+
+def test_registry_prefers_custom_mappings_over_the_generic_guess():
+    custom = BankFormatMapping(name="Mine", header="Date,Description,Amount,Balance", date_column="Date",
+                               description_column="Description", amount_column="Balance")
+    registry = BankFormatRegistry([format_from_mapping(custom)] + BUILTIN_FORMATS)
+    assert registry.detect(_rows("generic.csv")[0]).amount_idx == 3
+    assert BankFormatRegistry(BUILTIN_FORMATS).detect(_rows("generic.csv")[0]).amount_idx == 2
+
+def test_semicolon_statement_imports_through_a_custom_format(client, seed):
+    seeded = seed(0)
+    created = client.post("/imports/formats", json=SEMICOLON.model_dump(exclude={"id"}))
+    assert created.status_code == 200, created.text
+    with open(os.path.join(SAMPLES, "semicolon.csv"), "rb") as sample:
+        detected = client.post("/imports/formats/detect", files={"file": ("semicolon.csv", sample, "text/csv")})
+    assert detected.json()["name"] == "Caixa"
+
+    with open(os.path.join(SAMPLES, "semicolon.csv"), "rb") as sample:
+        imported = client.post("/imports/upload", params={"account_id": seeded["account"]["id"]},
+                               files={"file": ("semicolon.csv", sample, "text/csv")})
+    assert imported.status_code == 200, imported.text
+    amounts = {t["description"]: t["amount"] for t in client.get("/transactions/").json()}
+    assert amounts == {"Pingo Doce, Lisboa": -12.5, "Farmácia Central": -8.2}
@@ -0,0 +1,22 @@
+def test_deleting_a_referenced_category_is_409(client, seed):
+    seeded = seed(1)
+    response = client.delete(f"/categories/{seeded['category_id']}")
+    assert response.status_code == 409
+    assert "transactions" in response.json()["detail"]
+    assert client.get(f"/transactions/{seeded['ids'][0]}").json()["category_name"]
+
+def test_deleting_an_unused_category_succeeds(client):
+    category = client.post("/categories/", json={"name": "Unused", "icon": "x"}).json()
+    assert client.delete(f"/categories/{category['id']}").status_code == 200
+
+def test_deleting_a_referenced_account_or_user_is_409(client, seed):
+    seeded = seed(1)
+    assert client.delete(f"/accounts/{seeded['account']['id']}").status_code == 409
+    assert client.delete(f"/users/{seeded['user']['id']}").status_code == 409
+
+def test_deleting_a_trip_untags_its_transactions(client, seed):
+    seeded = seed(2)
+    assert client.delete(f"/trips/{seeded['trip']['id']}").status_code == 200
+    for transaction_id in seeded["ids"]:
+        assert client.get(f"/transactions/{transaction_id}").json()["trip_id"] is None
+    assert client.get("/stats/rollup/check").json()["consistent"]
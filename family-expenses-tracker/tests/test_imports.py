@@ -0,0 +1,33 @@
+from sqlalchemy import text
+
+from importer import fingerprint_key, transaction_fingerprint
+
+def _upload(client, account_id, body):
+    response = client.post("/imports/upload", params={"account_id": account_id},
+                           files={"file": ("statement.csv", body.encode(), "text/csv")})
+    assert response.status_code == 200, response.text
+    return response.json()
+
+def test_rows_matching_a_hand_entered_transaction_conflict(client, seed):
+    seeded = seed(1) # "Shop 0", -10.0 on 2025-03-01
+    result = _upload(client, seeded["account"]["id"], "Date,Description,Amount\n2025-03-01,SHOP ZERO LISBOA,-10.00\n")
+    assert (result["inserted"], result["conflicting"]) == (1, 1)
+
+def test_rows_matching_a_hand_entered_transaction_from_before_v6_conflict(client, engine, seed):
+    # The v6 migration fingerprinted every existing row, hand-entered ones included
+    seeded = seed(1)
+    account_id = seeded["account"]["id"]
+    with engine.begin() as conn:
+        conn.execute(text('UPDATE "transaction" SET fingerprint = :fingerprint WHERE id = :tx_id'), {
+            "tx_id": seeded["ids"][0],
+            "fingerprint": transaction_fingerprint(fingerprint_key(account_id, "2025-03-01", -10.0, "Shop 0"), 0),
+        })
+    result = _upload(client, account_id, "Date,Description,Amount\n2025-03-01,SHOP ZERO LISBOA,-10.00\n")
+    assert (result["inserted"], result["conflicting"]) == (1, 1)
+
+def test_rows_matching_an_earlier_import_do_not_conflict(client, seed):
+    seeded = seed(0)
+    account_id = seeded["account"]["id"]
+    _upload(client, account_id, "Date,Description,Amount\n2025-03-01,Bakery,-10.00\n")
+    result = _upload(client, account_id, "Date,Description,Amount\n2025-03-01,Bakery,-10.00\n2025-03-01,Butcher,-10.00\n")
+    assert (result["inserted"], result["skipped"], result["conflicting"]) == (1, 1, 0)
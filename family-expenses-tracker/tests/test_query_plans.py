@@ -0,0 +1,32 @@
+import pytest
+
+def _plan(engine, statement, parameters):
+    connection = engine.raw_connection()
+    try:
+        return [row[3] for row in connection.execute(f"EXPLAIN QUERY PLAN {statement}", parameters).fetchall()]
+    finally:
+        connection.close()
+
+def _transaction_list_filters(seeded, cursor):
+    return {
+        "account": {"account_id": seeded["account"]["id"]},
+        "category": {"category_id": seeded["category_id"]},
+        "trip": {"trip_id": seeded["trip"]["id"]},
+        "date range": {"start_date": "2025-03-01", "end_date": "2025-03-15"},
+        "account and date range": {"account_id": seeded["account"]["id"], "start_date": "2025-03-01", "end_date": "2025-03-15"},
+        "cursor": {"cursor": cursor},
+    }
+
+@pytest.mark.parametrize("name", ["account", "category", "trip", "date range", "account and date range", "cursor"])
+def test_transaction_filters_use_an_index(client, engine, statements, seed, name):
+    seeded = seed(5)
+    cursor = client.get("/transactions/", params={"limit": 1}).headers["X-Next-Cursor"]
+    params = _transaction_list_filters(seeded, cursor)[name]
+
+    statements.clear()
+    assert client.get("/transactions/", params=params).status_code == 200
+    (statement, parameters), = [(s, p) for s, p in statements if s.lstrip().upper().startswith("SELECT")]
+
+    plan = _plan(engine, statement, parameters)
+    # A full pass over the table, bare or along an index, is a regression
+    assert not any(detail.startswith("SCAN transaction") for detail in plan), plan
@@ -0,0 +1,55 @@
+import random
+
+import pytest
+
+from rule_matcher import RuleMatcher
+
+def naive_match_rule(rules, description):
+    # The loop RuleMatcher replaced: rules in id order, first substring hit wins.
+    # Blank patterns are skipped, as they would otherwise match every description.
+    description = description.lower()
+    for rule_id, pattern, category_id in sorted(rules):
+        if pattern.strip() and pattern.lower() in description:
+            return rule_id, category_id
+    return None
+
+RULES = [
+    (7, "bucks", 70),
+    (3, "STARBUCKS", 30),
+    (5, "star", 50),
+    (9, "café", 90),
+    (2, "uber *trip", 20),
+    (4, "  ", 40),
+    (8, "ucks", 80),
+]
+
+@pytest.mark.parametrize("description, expected", [
+    ("STARBUCKS 1234", (3, 30)),            # three patterns match; the lowest id wins, not the longest or first
+    ("starbucks", (3, 30)),
+    ("Five Star Hotel", (5, 50)),
+    ("the bucks stop here", (7, 70)),       # "ucks" (8) also ends here, via a failure link
+    ("trucks", (8, 80)),
+    ("CAFÉ Nicola", (9, 90)),
+    ("UBER *TRIP HELP.UBER.COM", (2, 20)),
+    ("uber trip", None),
+    ("   ", None),                          # a blank pattern never matches
+    ("", None),
+])
+def test_match_rule_agrees_with_the_naive_loop(description, expected):
+    matcher = RuleMatcher(RULES)
+    assert naive_match_rule(RULES, description) == expected
+    assert matcher.match_rule(description) == expected
+    assert matcher.match(description) == (expected[1] if expected else None)
+    assert matcher.rule_count == 6
+
+def test_match_rule_agrees_with_the_naive_loop_on_random_rules():
+    # A small alphabet makes overlapping, nested and repeated patterns common
+    rng = random.Random(11)
+    alphabet = "abcAB "
+    for _ in range(50):
+        ids = rng.sample(range(1, 1000), 40)
+        rules = [(rule_id, "".join(rng.choices(alphabet, k=rng.randint(1, 4))), rng.randint(1, 5)) for rule_id in ids]
+        matcher = RuleMatcher(rules)
+        for _ in range(40):
+            description = "".join(rng.choices(alphabet, k=rng.randint(0, 20)))
+            assert matcher.match_rule(description) == naive_match_rule(rules, description), (rules, description)
@@ -0,0 +1,42 @@
+import pytest
+
+import database
+
+DESCRIPTIONS = ["STARBUCKS 1234 LISBON", "Starbucks Coffee", "Buckle & Co", "Amazon Marketplace", 'The "Corner" Shop', "Uber *Trip"]
+
+@pytest.fixture
+def described(client, seed):
+    seeded = seed(0)
+    ids = {}
+    for description in DESCRIPTIONS:
+        created = client.post("/transactions/", json={
+            "date": "2025-03-01", "amount": -4.5, "description": description,
+            "category_id": seeded["category_id"], "account_id": seeded["account"]["id"], "user_id": seeded["user"]["id"],
+        })
+        ids[description] = created.json()["id"]
+    return ids
+
+def _search(client, search):
+    response = client.get("/transactions/", params={"search": search, "limit": 100})
+    assert response.status_code == 200
+    return {t["description"] for t in response.json()}
+
+@pytest.mark.parametrize("search", ["buck", "BUCKS", "bucks 1234", "rbuck", "market", 'corner"', "r *t", "bu", "x", "nothing"])
+def test_search_matches_like_substring(client, described, search):
+    # The behaviour pinned since before the index: a case-insensitive substring match on the description
+    assert _search(client, search) == {d for d in DESCRIPTIONS if search.lower() in d.lower()}
+
+def test_search_uses_the_index_for_three_characters_or_more(client, described, statements):
+    assert database.FTS_ENABLED
+    statements.clear()
+    _search(client, "buck")
+    assert any("transaction_fts MATCH" in s for s, _ in statements)
+
+    statements.clear()
+    _search(client, "bu")
+    assert not any("transaction_fts" in s for s, _ in statements)
+
+def test_search_follows_description_edits(client, described):
+    client.put(f"/transactions/{described['Amazon Marketplace']}", json={"description": "Bakery Pastel"})
+    assert _search(client, "market") == set()
+    assert _search(client, "astel") == {"Bakery Pastel"}
@@ -0,0 +1,49 @@
+import pytest
+
+def _selects(statements):
+    return [s for s, _ in statements if s.lstrip().upper().startswith("SELECT")]
+
+@pytest.mark.parametrize("rows", [1, 25])
+def test_list_is_one_select(client, statements, seed, rows):
+    seed(rows)
+    statements.clear()
+    response = client.get("/transactions/", params={"limit": 100})
+    assert response.status_code == 200
+    page = response.json()
+    assert len(page) == rows
+    assert all(t["category_name"] and t["account_name"] and t["user_name"] and t["trip_name"] for t in page)
+    assert len(_selects(statements)) == 1
+
+@pytest.mark.parametrize("rows", [1, 25])
+def test_get_is_one_select(client, statements, seed, rows):
+    seeded = seed(rows)
+    statements.clear()
+    response = client.get(f"/transactions/{seeded['ids'][-1]}")
+    assert response.status_code == 200
+    assert response.json()["trip_name"] == "Lisbon"
+    assert len(_selects(statements)) == 1
+
+@pytest.mark.parametrize("rows", [1, 25])
+def test_create_is_one_select(client, statements, seed, rows):
+    seeded = seed(rows)
+    statements.clear()
+    response = client.post("/transactions/", json={
+        "date": "2025-04-01", "amount": -5.0, "description": "Bakery",
+        "category_id": seeded["category_id"], "account_id": seeded["account"]["id"], "user_id": seeded["user"]["id"],
+    })
+    assert response.status_code == 200
+    assert response.json()["account_name"] == "Checking"
+    assert len(_selects(statements)) == 1
+
+@pytest.mark.parametrize("rows", [1, 25])
+def test_update_is_one_select(client, statements, seed, rows):
+    seeded = seed(rows)
+    statements.clear()
+    response = client.put(f"/transactions/{seeded['ids'][0]}", json={"description": "Bakery"})
+    assert response.status_code == 200
+    assert response.json()["description"] == "Bakery"
+    assert response.json()["user_name"] == "Alex"
+    assert len(_selects(statements)) == 1
+
+def test_update_missing_transaction_is_404(client):
+    assert client.put("/transactions/999999", json={"description": "x"}).status_code == 404